@@ -1,116 +1,350 @@
 #!/usr/bin/env python
 # Remove particles that will lie close to edge or outside micrograph after recentring. Author: Huw Jenkins 27.11.24
+# Read from stdin and write to stdout with - 19.10.26
+# Pixel sizes and micrograph dimensions for each optics group, particles filtered in vectorised chunks 19.10.26
+# edge_mask() for columns already loaded by another script 19.10.26
+# Write recentred coordinates of retained particles for re-extraction with --coordinates_dir 19.10.26
 
+import os
+import sys
 import argparse
+from collections import OrderedDict
+from contextlib import ExitStack
+from itertools import islice
 import numpy as np
 from scipy.spatial.transform import Rotation as R
+from star_io import read_parquet, open_star, read_star, read_headers
 
-def euler_angles2matrix_scipy(alpha, beta, gamma):
-  # This reproduces result of Euler_angles2matrix() from RELION src/euler.cpp
-  alpha = np.radians(alpha)
-  beta  = np.radians(beta)
-  gamma = np.radians(gamma)
-  A = R.from_euler('ZYZ', (alpha, beta, gamma))
-  return A.as_matrix().T
-
-def print_info(particle_angpix, orig_angpix, recenter_x, recenter_y, recenter_z, mic_x, mic_y, distance, particle_diameter):
-  print(f"Micrographs have dimensions: {mic_x} x {mic_y} px and pixel size of {orig_angpix} A")
-  if mic_x != mic_y:
-    print(f"WARNING! Micrographs are not square - check orientation is correct!!")
+def recentre_coordinates(xcoord, ycoord, xoff, yoff, rot, tilt, psi, center, particle_angpix, rescale):
+  # This reproduces result of getCoordinateMetaDataTable() from RELION src/preprocessing.cpp for whole columns.
+  # The transform is Euler_angles2matrix() from RELION src/euler.cpp. particle_angpix and rescale can be
+  # per particle arrays.
+  transform = R.from_euler('ZYZ', np.radians(np.column_stack((rot, tilt, psi)))).as_matrix().transpose(0, 2, 1)
+  projected_center = transform @ center
+  xoff = (xoff / particle_angpix - projected_center[:, 0]) * rescale # now in micrograph px
+  yoff = (yoff / particle_angpix - projected_center[:, 1]) * rescale # now in micrograph px
+  return xcoord - np.round(xoff), ycoord - np.round(yoff)
+
+def print_info(groups, recenter_x, recenter_y, recenter_z, particle_diameter, file=sys.stdout):
   recenter = [recenter_x, recenter_y, recenter_z]
-  recenter_ang = [c * particle_angpix for c in recenter]
-  print(f"After applying recentring of {recenter} px ({recenter_ang} A assuming {particle_angpix} A/px in reference) ")
-  if particle_diameter != 0:
-    print(f"Particle diameter of {particle_diameter} A is {particle_diameter/orig_angpix:.3f} px in micrograph. "
-          f"1/2 particle diameter is {0.5 * (particle_diameter/orig_angpix):.3f} px")
-  print(f"Particles closer than {distance} px ({distance * orig_angpix:0.3f} A) to edge of micrographs will be removed")
-  print(f"Remaining particles will have center in range {distance} - {mic_x - distance - 1} in X and {distance} - {mic_y - distance - 1} in Y")
-
-def read_headers(star_file):
+  if len(set(groups.values())) == 1:
+    groups = {min(groups):groups[min(groups)]}
+  for g, (particle_angpix, orig_angpix, mic_x, mic_y, distance) in groups.items():
+    mic_x, mic_y, distance = int(mic_x), int(mic_y), int(distance)
+    if len(groups) > 1:
+      print(f"Optics group {g}:", file=file)
+    print(f"Micrographs have dimensions: {mic_x} x {mic_y} px and pixel size of {orig_angpix} A", file=file)
+    if mic_x != mic_y:
+      print(f"WARNING! Micrographs are not square - check orientation is correct!!", file=file)
+    recenter_ang = [c * particle_angpix for c in recenter]
+    print(f"After applying recentring of {recenter} px ({recenter_ang} A assuming {particle_angpix} A/px in reference) ", file=file)
+    if particle_diameter != 0:
+      print(f"Particle diameter of {particle_diameter} A is {particle_diameter/orig_angpix:.3f} px in micrograph. "
+            f"1/2 particle diameter is {0.5 * (particle_diameter/orig_angpix):.3f} px", file=file)
+    print(f"Particles closer than {distance} px ({distance * orig_angpix:0.3f} A) to edge of micrographs will be removed", file=file)
+    print(f"Remaining particles will have center in range {distance} - {mic_x - distance - 1} in X and {distance} - {mic_y - distance - 1} in Y", file=file)
+
+def read_optics(lines):
+  # {optics group: {label: value}} from the data_optics block of the header lines
+  optics = {}
   data = False
-  with open(star_file) as f:
-    for line in f:
-      if line[0:5] == 'data_' and line.strip()[5:] in ['', 'particles', 'micrographs']:
-        data = True
-        labels = []
-      elif data and line[0] == '_':
-        labels.append(line[line.find('_') + 1:line.find('#') - 1])
-      elif data and len(labels) > 0:
-        return labels
-      else:
-         continue
-
-def filter_particles(star_file, output_file, particle_angpix, orig_angpix, recenter_x, recenter_y, recenter_z, mic_x, mic_y, distance, particle_diameter, verbose, debug):
-  print(f"Reading particles from {star_file}....")
-  rescale = particle_angpix / orig_angpix
-  labels = read_headers(star_file)
-  xo, yo = labels.index('rlnOriginXAngst'), labels.index('rlnOriginYAngst')
-  x, y = labels.index('rlnCoordinateX'), labels.index('rlnCoordinateY')
-  r, t, p = labels.index('rlnAngleRot'), labels.index('rlnAngleTilt'), labels.index('rlnAnglePsi')
-  if particle_diameter != 0:
-    distance = int(0.5 * (particle_diameter/orig_angpix))
-  print_info(particle_angpix, orig_angpix, recenter_x, recenter_y, recenter_z, mic_x, mic_y, distance, particle_diameter)
+  for line in lines:
+    if line[0:5] == 'data_':
+      data = line.strip() == 'data_optics'
+      labels = []
+    elif data and line[0] == '_':
+      labels.append(line[line.find('_') + 1:line.find('#') - 1])
+    elif data and len(labels) > 0 and line.strip() != '' and line[0] != '#':
+      row = dict(zip(labels, line.split()))
+      optics[int(row['rlnOpticsGroup'])] = row
+  return optics
+
+def optics_groups(optics, particle_angpix, orig_angpix, mic_x, mic_y, mic_sizes, distance, particle_diameter):
+  # (reference A/px, micrograph A/px, micrograph X, Y and edge distance in px) for each optics group
+  # or ValueError if any of them is missing.
+  # Pixel sizes given on the command line are used for every group, otherwise they come from the optics
+  # table. _rlnMicrographOriginalPixelSize is the movie pixel size, which differs from the micrograph pixel
+  # size for super-resolution or binned movies, so without _rlnMicrographPixelSize --orig_angpix is needed.
+  # --mic_x and --mic_y are used for groups without their own --mic_size.
+  for g in mic_sizes:
+    if len(optics) > 0 and g not in optics:
+      raise ValueError(f"there is no optics group {g} for --mic_size")
+  groups = {}
+  for g in sorted(optics) if len(optics) > 0 else [1]:
+    row = optics.get(g, {})
+    angpix = particle_angpix if particle_angpix is not None else row.get('rlnImagePixelSize')
+    mic_angpix = orig_angpix if orig_angpix is not None else row.get('rlnMicrographPixelSize')
+    size = mic_sizes.get(g, (mic_x, mic_y))
+    if angpix is None:
+      raise ValueError(f"no _rlnImagePixelSize for optics group {g} - give --particle_angpix")
+    if mic_angpix is None:
+      original = f" (_rlnMicrographOriginalPixelSize {row['rlnMicrographOriginalPixelSize']} is the movie pixel size)" if 'rlnMicrographOriginalPixelSize' in row else ''
+      raise ValueError(f"no _rlnMicrographPixelSize for optics group {g}{original} - give --orig_angpix")
+    if None in size:
+      raise ValueError(f"no micrograph size for optics group {g} - give --mic_x and --mic_y or --mic_size {g}:X:Y")
+    angpix, mic_angpix = float(angpix), float(mic_angpix)
+    d = int(0.5 * (particle_diameter/mic_angpix)) if particle_diameter != 0 else distance
+    groups[g] = (angpix, mic_angpix, size[0], size[1], d)
+  return groups
+
+def group_lookup(groups):
+  # rows of per group values indexed by optics group number so a column of
+  # optics groups can be turned into per particle values in one step
+  lookup = np.full((5, max(groups) + 1), np.nan)
+  for g, values in groups.items():
+    lookup[:, g] = values
+  return lookup
+
+EDGE_LABELS = ['rlnCoordinateX', 'rlnCoordinateY', 'rlnOriginXAngst', 'rlnOriginYAngst', 'rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi']
+
+def edge_filter(columns, lookup, center):
+  # columns are {label: numpy array} for EDGE_LABELS and _rlnOpticsGroup (if there is more than one group)
+  xcoord, ycoord, xoff, yoff, rot, tilt, psi = [columns[label] for label in EDGE_LABELS]
+  if 'rlnOpticsGroup' in columns:
+    og = columns['rlnOpticsGroup'].astype(int)
+  else:
+    og = np.full(len(xcoord), np.flatnonzero(~np.isnan(lookup[0]))[0])
+  if og.min() < 0 or og.max() >= lookup.shape[1] or np.isnan(lookup[0, og]).any():
+    raise ValueError(f"particles in optics group {sorted(set(og.tolist()) - set(np.flatnonzero(~np.isnan(lookup[0])).tolist()))} are not in the optics table")
+  particle_angpix, orig_angpix, mic_x, mic_y, distance = lookup[:, og]
+  xcoord, ycoord = recentre_coordinates(xcoord, ycoord, xoff, yoff, rot, tilt, psi, center, particle_angpix, particle_angpix / orig_angpix)
+  keep = (xcoord >= distance) & (xcoord < mic_x - distance) & (ycoord >= distance) & (ycoord < mic_y - distance)
+  return xcoord, ycoord, keep
+
+def edge_mask(columns, groups, recenter=(0, 0, 0)):
+  # Recentred coordinates and which particles are kept for already loaded columns with the
+  # optics groups from optics_groups
+  return edge_filter(columns, group_lookup(groups), np.array(recenter))
+
+CHUNK_SIZE = 100000 # particles converted and filtered at a time
+
+def read_chunks(lines, size):
+  while True:
+    chunk = list(islice(lines, size))
+    if len(chunk) == 0:
+      return
+    yield chunk
+
+BUFFER_SIZE = 1 << 20 # keep diagnostic output from making the terminal the bottleneck
+
+def write_loss_report(losses, report_file, info=sys.stdout):
+  # losses is {micrograph: [retained, rejected]}
+  with open(report_file, 'w', buffering=BUFFER_SIZE) as f:
+    f.write('Micrograph                                                         retained rejected\n')
+    for mic, (retained, rejected) in sorted(losses.items(), key=lambda x: (-x[1][1] / (x[1][0] + x[1][1]), x[0])):
+      f.write(f"{mic:<66s} {retained:8d} {rejected:8d}\n")
+  print(f"...retained and rejected particles per micrograph written to {report_file}", file=info)
+
+MAX_OPEN_FILES = 256 # per-micrograph coordinate files kept open at once
+COORDINATE_BUFFER_SIZE = 1 << 16
+
+def coordinate_file_name(mic, coordinates_dir):
+  # MotionCorr/job002/Movies/mic0001.mrc -> coordinates_dir/Movies/mic0001_coords.star as AutoPick does
+  parts = [p for p in mic.split('/') if p not in ['', '.', '..']]
+  if len(parts) > 2 and parts[1].startswith('job'):
+    parts = parts[2:]
+  return os.path.join(coordinates_dir, *parts[:-1], os.path.splitext(parts[-1])[0] + '_coords.star')
+
+class CoordinateWriter:
+  # Coordinates streamed into one star file per micrograph. At most MAX_OPEN_FILES are open at once,
+  # the least recently used is closed and reopened for appending if it is needed again.
+  def __init__(self, coordinates_dir, version):
+    self.coordinates_dir = coordinates_dir
+    self.version = version
+    self.files = {} # {micrograph: coordinate file}
+    self.paths = set()
+    self.open_files = OrderedDict()
+    self.n = 0
+
+  def open(self, mic):
+    path = self.files.get(mic)
+    if path in self.open_files:
+      self.open_files.move_to_end(path)
+      return self.open_files[path]
+    if path is None:
+      path = coordinate_file_name(mic, self.coordinates_dir)
+      if path in self.paths:
+        sys.exit(f"Sorry {mic} and another micrograph would both have coordinates in {path}")
+      self.files[mic] = path
+      self.paths.add(path)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      f = open(path, 'w', buffering=COORDINATE_BUFFER_SIZE)
+      f.write(f"\n{self.version}\n\ndata_\n\nloop_ \n_rlnCoordinateX #1 \n_rlnCoordinateY #2 \n")
+    else:
+      f = open(path, 'a', buffering=COORDINATE_BUFFER_SIZE)
+    self.open_files[path] = f
+    if len(self.open_files) > MAX_OPEN_FILES:
+      self.open_files.popitem(last=False)[1].close()
+    return f
+
+  def add(self, mics, xcoord, ycoord):
+    # one write per micrograph for a chunk of particles, keeping the order of the particles on each micrograph
+    names, inverse = np.unique(np.asarray(mics), return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    ends = np.cumsum(np.bincount(inverse, minlength=len(names)))
+    start = 0
+    for mic, end in zip(names.tolist(), ends.tolist()):
+      i = order[start:end]
+      self.open(mic).writelines(f"{x:12.6f} {y:12.6f} \n" for x, y in zip(xcoord[i].tolist(), ycoord[i].tolist()))
+      start = end
+    self.n += len(order)
+
+  def close(self):
+    # close the coordinate files and write the list of them for Extract
+    for f in self.open_files.values():
+      f.close()
+    self.open_files.clear()
+    list_file = os.path.join(self.coordinates_dir, 'coordinates.star')
+    with open(list_file, 'w', buffering=BUFFER_SIZE) as f:
+      f.write(f"\n{self.version}\n\ndata_coordinate_files\n\nloop_ \n_rlnMicrographName #1 \n_rlnMicrographCoordinates #2 \n")
+      f.writelines(f"{mic} {path} \n" for mic, path in sorted(self.files.items()))
+    return list_file
+
+def star_version(lines):
+  for line in lines:
+    if line.startswith('# version'):
+      return line.strip()
+  return '# version 30001'
+
+def filter_particles(star_file, output_file, particle_angpix, orig_angpix, recenter_x, recenter_y, recenter_z, mic_x, mic_y, distance, particle_diameter, verbose, debug,
+                     rejected_file=None, loss_report=None, log_file=None, mic_sizes={}, coordinates_dir=None):
+  # summaries go to stderr when the filtered star file goes to stdout
+  info = sys.stderr if output_file == '-' else sys.stdout
+  print(f"Reading particles from {star_file}....", file=info)
+  if star_file.endswith('.parquet'):
+    labels = read_headers(star_file, ['', 'particles', 'micrographs'])
+    optics_file = star_file.replace('_particles.parquet', '_optics.parquet')
+    optics = {}
+    header = []
+    if optics_file != star_file and os.path.isfile(optics_file):
+      optics = {int(row['rlnOpticsGroup']):row for row in read_parquet(optics_file).read().to_pylist()}
+  else:
+    f = open_star(star_file)
+    header, labels, lines = read_star(f, ['', 'particles', 'micrographs'])
+    optics = read_optics(header)
+  groups = optics_groups(optics, particle_angpix, orig_angpix, mic_x, mic_y, mic_sizes, distance, particle_diameter)
+  print_info(groups, recenter_x, recenter_y, recenter_z, particle_diameter, info)
+  lookup = group_lookup(groups)
+  center = np.array([recenter_x, recenter_y, recenter_z])
+  names = EDGE_LABELS + (['rlnOpticsGroup'] if 'rlnOpticsGroup' in labels else [])
+  index = [labels.index(label) for label in names]
+  if loss_report is not None or coordinates_dir is not None:
+    if 'rlnMicrographName' not in labels:
+      sys.exit(f"Sorry could not find _rlnMicrographName in {star_file}")
+    m = labels.index('rlnMicrographName')
+  coordinates = CoordinateWriter(coordinates_dir, star_version(header)) if coordinates_dir is not None else None
   n_rejected = 0
   n_retained = 0
   n_particles = 0
-  with open(output_file, 'w') as fout:
-    with open(star_file) as f:
-      data = False
-      for line in f:
-        if data and line.strip() != '':
-          n_particles+=1
-          items = line.split()
-          xoff, yoff = float(items[xo]), float(items [yo])
-          rot, tilt, psi = float(items[r]), float(items[t]), float(items[p])
-          xcoord, ycoord = float(items[x]), float(items[y])
-          # This code reproduces result of getCoordinateMetaDataTable() from RELION src/preprocessing.cpp
-          xoff /= particle_angpix # now in px
-          yoff /= particle_angpix # now in px
-          center = np.array([recenter_x, recenter_y, recenter_z])
-          transform = euler_angles2matrix_scipy(rot, tilt, psi)
-          projected_center = np.dot(transform, center)
-          xoff -= projected_center[0]
-          yoff -= projected_center[1]
-          xoff *= rescale # now in micrograph px
-          yoff *= rescale # now in micrograph px
-          xcoord -= round(xoff, 0)
-          ycoord -= round(yoff, 0)
-          if debug:
-            print(f"center: {center}")
-            print("transform:")
-            print(transform)
-            print(f"projected_center: {projected_center}")
-            print(f"coordinates: [{xcoord:4.0f}, {ycoord:4.0f}, 0]")
-          if xcoord < distance or xcoord >= mic_x - distance or ycoord < distance or ycoord >= mic_y - distance:
-            if verbose:
-              print(f"Particle with centre: {xcoord:4.0f} {ycoord:4.0f} removed")
-            n_rejected+=1
-          else:
-            n_retained+=1
-            fout.write(line)
-        elif line.startswith('_' + labels[-1]):
-          data = True
-          fout.write(line)
-        else:
-          fout.write(line)
-          continue
-  print(f"{n_rejected} of {n_particles} particles removed.")
-  print(f"...{n_retained} particles written to {output_file}")
+  losses = {}
+  if star_file.endswith('.parquet'):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    pf = read_parquet(star_file)
+    table = pf.read(columns=names)
+    columns = {label:table.column(label).to_numpy() for label in names}
+    xcoord, ycoord, keep = edge_filter(columns, lookup, center)
+    if verbose or debug:
+      with ExitStack() as stack:
+        log = stack.enter_context(open(log_file, 'w', buffering=BUFFER_SIZE)) if log_file is not None else info
+        if debug:
+          og = columns.get('rlnOpticsGroup', np.full(len(keep), min(groups)))
+          log.writelines(f"optics group: {g:.0f} coordinates: [{xc:4.0f}, {yc:4.0f}, 0]\n" for g, xc, yc in zip(og, xcoord, ycoord))
+        if verbose:
+          log.writelines(f"Particle with centre: {xc:4.0f} {yc:4.0f} removed\n" for xc, yc in zip(xcoord[~keep], ycoord[~keep]))
+    table = pf.read()
+    pq.write_table(table.filter(pa.array(keep)), output_file)
+    n_particles = len(keep)
+    n_retained = int(keep.sum())
+    print(f"{n_particles - n_retained} of {n_particles} particles removed.", file=info)
+    print(f"...{n_retained} particles written to {output_file}", file=info)
+    if rejected_file is not None:
+      pq.write_table(table.filter(pa.array(~keep)), rejected_file)
+      print(f"...{n_particles - n_retained} rejected particles written to {rejected_file}", file=info)
+    if loss_report is not None:
+      mics, inverse = np.unique(table.column(labels[m]).to_numpy(), return_inverse=True)
+      retained = np.bincount(inverse, weights=keep, minlength=len(mics)).astype(int)
+      rejected = np.bincount(inverse, minlength=len(mics)) - retained
+      write_loss_report({mic:[a, b] for mic, a, b in zip(mics, retained.tolist(), rejected.tolist())}, loss_report, info)
+    if coordinates is not None:
+      coordinates.add(table.column(labels[m]).filter(pa.array(keep)).to_numpy(zero_copy_only=False), xcoord[keep], ycoord[keep])
+      print(f"...recentred coordinates of {coordinates.n} particles on {len(coordinates.files)} micrographs listed in {coordinates.close()}", file=info)
+    return
+  with ExitStack() as stack:
+    stack.enter_context(f)
+    if output_file == '-':
+      sys.stdout.flush()
+      fout = stack.enter_context(open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE, closefd=False))
+    else:
+      fout = stack.enter_context(open(output_file, 'w', buffering=BUFFER_SIZE))
+    frej = stack.enter_context(open(rejected_file, 'w', buffering=BUFFER_SIZE)) if rejected_file is not None else None
+    if log_file is not None:
+      log = stack.enter_context(open(log_file, 'w', buffering=BUFFER_SIZE))
+    else:
+      info.flush()
+      log = stack.enter_context(open(info.fileno(), 'w', buffering=BUFFER_SIZE, closefd=False))
+    fout.writelines(header)
+    if frej is not None:
+      frej.writelines(header)
+    for chunk in read_chunks(lines, CHUNK_SIZE):
+      items = [line.split() for line in chunk]
+      columns = dict(zip(names, np.array([[item[i] for i in index] for item in items], dtype=float).reshape(-1, len(index)).T))
+      xcoord, ycoord, keep = edge_filter(columns, lookup, center)
+      if debug:
+        og = columns.get('rlnOpticsGroup', np.full(len(chunk), min(groups)))
+        log.writelines(f"optics group: {g:.0f} coordinates: [{xc:4.0f}, {yc:4.0f}, 0]\n" for g, xc, yc in zip(og, xcoord, ycoord))
+      if verbose:
+        log.writelines(f"Particle with centre: {xc:4.0f} {yc:4.0f} removed\n" for xc, yc in zip(xcoord[~keep], ycoord[~keep]))
+      fout.writelines(line for line, k in zip(chunk, keep) if k)
+      if frej is not None:
+        frej.writelines(line for line, k in zip(chunk, keep) if not k)
+      if coordinates is not None:
+        coordinates.add([item[m] for item, k in zip(items, keep) if k], xcoord[keep], ycoord[keep])
+      if loss_report is not None:
+        for mic, k in zip([item[m] for item in items], keep.tolist()):
+          try:
+            losses[mic][0 if k else 1] += 1
+          except KeyError:
+            losses[mic] = [1, 0] if k else [0, 1]
+      n_particles += len(chunk)
+      n_retained += int(keep.sum())
+    n_rejected = n_particles - n_retained
+  print(f"{n_rejected} of {n_particles} particles removed.", file=info)
+  print(f"...{n_retained} particles written to {output_file}", file=info)
+  if rejected_file is not None:
+    print(f"...{n_rejected} rejected particles written to {rejected_file}", file=info)
+  if loss_report is not None:
+    write_loss_report(losses, loss_report, info)
+  if coordinates is not None:
+    print(f"...recentred coordinates of {coordinates.n} particles on {len(coordinates.files)} micrographs listed in {coordinates.close()}", file=info)
+
+def parse_mic_sizes(mic_sizes):
+  # --mic_size 1:4096:4096 --mic_size 2:5760:4092
+  sizes = {}
+  for mic_size in mic_sizes:
+    try:
+      g, x, y = [int(v) for v in mic_size.split(':')]
+    except ValueError:
+      sys.exit(f"Error: --mic_size should be GROUP:X:Y not {mic_size}")
+    sizes[g] = (x, y)
+  return sizes
 
 if __name__=='__main__':
   parser = argparse.ArgumentParser(description='Remove particles that will be close to edge (or off edge) of micrograph after recentring')
   parser.add_argument('star_file', metavar='run_data.star', type=str,
-                      help='star file from Refine3D or Class3D')
+                      help='star file from Refine3D or Class3D (or run_data_particles.parquet from star_to_parquet.py, - for stdin)')
   parser.add_argument('--output_file', required=False, default='filtered.star', metavar='filtered.star', type=str,
-                      help='output star file')
-  parser.add_argument('--particle_angpix', required=True, default=None, metavar='1.0', type=float,
-                      help='Reference A/pix')
-  parser.add_argument('--orig_angpix', required=True, default=None, metavar='1.0', type=float,
-                      help='A/pix in micrographs')
-  parser.add_argument('--mic_x', required=True, default=None, metavar='4096', type=int,
+                      help='output star file (- for stdout with the summary on stderr)')
+  parser.add_argument('--particle_angpix', required=False, default=None, metavar='1.0', type=float,
+                      help='Reference A/pix (default: _rlnImagePixelSize of each optics group)')
+  parser.add_argument('--orig_angpix', required=False, default=None, metavar='1.0', type=float,
+                      help='A/pix in micrographs (default: _rlnMicrographPixelSize of each optics group)')
+  parser.add_argument('--mic_x', required=False, default=None, metavar='4096', type=int,
                       help='Micrograph size in X in pixels (Falcon 4: 4096, K2: 3838, K3: 5760)')
-  parser.add_argument('--mic_y', required=True, default=None, metavar='4096', type=int,
+  parser.add_argument('--mic_y', required=False, default=None, metavar='4096', type=int,
                       help='Micrograph size in Y in pixels (Falcon 4: 4096, K2: 3710, K3: 4092)')
+  parser.add_argument('--mic_size', required=False, default=[], metavar='2:5760:4092', type=str, action='append',
+                      help='Micrograph size in pixels for one optics group as GROUP:X:Y (overrides --mic_x and --mic_y, can be repeated)')
   distance = parser.add_mutually_exclusive_group(required=False)
   distance.add_argument('--distance', default=0, metavar='0', type=int,
                       help='Remove particles with center closer than this distance in pixels to any edge of the micrograph')
@@ -126,19 +360,40 @@ if __name__=='__main__':
                       help='list particles that are removed')
   parser.add_argument('--debug', required=False, default=False, action='store_true',
                       help='print debugging information')
+  parser.add_argument('--log_file', required=False, default=None, metavar='clean_edges.log', type=str,
+                      help='write --verbose and --debug output to this file instead of the terminal')
+  parser.add_argument('--rejected_file', required=False, default=None, metavar='rejected.star', type=str,
+                      help='also write the particles that are removed to this star file')
+  parser.add_argument('--loss_report', required=False, default=None, metavar='loss.txt', type=str,
+                      help='write the number of retained and rejected particles on each micrograph to this file')
+  parser.add_argument('--coordinates_dir', required=False, default=None, metavar='External/job030', type=str,
+                      help='also write the recentred coordinates of retained particles to a star file per micrograph and list them in coordinates.star in this directory for re-extraction')
   args = parser.parse_args()
+  if args.star_file.endswith('.parquet'):
+    if args.output_file == 'filtered.star':
+      args.output_file = 'filtered.parquet'
+    if not args.output_file.endswith('.parquet') or (args.rejected_file is not None and not args.rejected_file.endswith('.parquet')):
+      sys.exit('Error: particles read from Parquet are written to Parquet - give an --output_file (and --rejected_file) ending in .parquet')
 
-  filter_particles(star_file=args.star_file, 
-                   output_file=args.output_file,
-                   particle_angpix=args.particle_angpix,
-                   orig_angpix=args.orig_angpix,
-                   mic_x=args.mic_x,
-                   mic_y=args.mic_y,
-                   distance=args.distance,
-                   particle_diameter=args.particle_diameter,
-                   recenter_x=args.recenter_x,
-                   recenter_y=args.recenter_y,
-                   recenter_z=args.recenter_z,
-                   verbose=args.verbose,
-                   debug=args.debug
-                  )
\ No newline at end of file
+  try:
+    filter_particles(star_file=args.star_file,
+                     output_file=args.output_file,
+                     particle_angpix=args.particle_angpix,
+                     orig_angpix=args.orig_angpix,
+                     mic_x=args.mic_x,
+                     mic_y=args.mic_y,
+                     distance=args.distance,
+                     particle_diameter=args.particle_diameter,
+                     recenter_x=args.recenter_x,
+                     recenter_y=args.recenter_y,
+                     recenter_z=args.recenter_z,
+                     verbose=args.verbose,
+                     debug=args.debug,
+                     rejected_file=args.rejected_file,
+                     loss_report=args.loss_report,
+                     log_file=args.log_file,
+                     mic_sizes=parse_mic_sizes(args.mic_size),
+                     coordinates_dir=args.coordinates_dir
+                    )
+  except ValueError as e:
+    sys.exit(f"Sorry {e}")
@@ -1,65 +1,110 @@
 #! /usr/bin/env python
 # Count particles in classes in RELION star file. Author Huw Jenkins 2019
 # Better header reading 02.04.21
+# class_counts() and class_resolutions() for use from other scripts 19.10.26
 from __future__ import print_function
 import os
 import sys
+import json
 import argparse
+import tempfile
+from multiprocessing import Pool
+import numpy as np
+from star_io import read_parquet, read_headers, data_lines, shard_lines, partial_name, add_shard_arguments, check_shard_arguments
 
-def read_headers(star_file):
-  got_labels = False
-  data = False
-  in_loop = False
-  with open(star_file) as f:
+def get_iteration(star_file):
+  # run_itNNN_data.star or run_itNNN_data_particles.parquet from star_to_parquet.py
+  name = os.path.split(star_file)[1]
+  return int(name[name.find('_it') + 3:name.find('_data')])
+
+def model_file(star_file):
+  if star_file.endswith('.parquet'):
+    parquet_file = star_file.replace('_data_particles.parquet', '_model_model_classes.parquet')
+    if os.path.isfile(parquet_file):
+      return parquet_file
+    return star_file.replace('_data_particles.parquet', '_model.star')
+  return star_file.replace('data','model')
+
+def count_lines(lines, n):
+  classes = {}
+  for line in lines:
+    items = line.split()
+    try:
+      classes[int(items[n])] +=1
+    except KeyError:
+      classes[int(items[n])] = 1
+  return classes
+
+def count_shard(star_files, shard, nshards, partial_dir):
+  # map step: class counts for one byte range of each data.star file
+  counts = {}
+  for star_file in star_files:
+    labels = read_headers(star_file)
+    counts[star_file] = list(count_lines(shard_lines(star_file, labels, shard, nshards), labels.index('rlnClassNumber')).items())
+  with open(partial_name(partial_dir, 'count_class', star_files, shard, nshards, 'json'), 'w') as f:
+    json.dump(counts, f)
+
+def read_partials(star_files, nshards, partial_dir):
+  # reduce step: sum class counts for each data.star file over all shards
+  counts = {}
+  for shard in range(nshards):
+    try:
+      with open(partial_name(partial_dir, 'count_class', star_files, shard, nshards, 'json')) as f:
+        partial = json.load(f)
+    except IOError:
+      sys.exit('Sorry could not find results for shard {} of {} in {}'.format(shard + 1, nshards, partial_dir))
+    for star_file in partial:
+      classes = counts.setdefault(star_file, {})
+      for cls, count in partial[star_file]:
+        classes[cls] = classes.get(cls, 0) + count
+  return counts
+
+def class_counts(columns):
+  # classes and number of particles in each from already loaded columns ({label: numpy array})
+  return np.unique(columns['rlnClassNumber'], return_counts=True)
+
+def class_resolutions(star_file):
+  # estimated resolution of each class (9999.99 for inf) from the model.star file of a data.star file
+  if model_file(star_file).endswith('.parquet'):
+    resolutions = read_parquet(model_file(star_file)).read(columns=['rlnEstimatedResolution']).column(0).to_numpy()
+    return np.where(np.isfinite(resolutions), resolutions, 9999.99)
+  resolutions = []
+  with open(model_file(star_file), 'r') as f:
+    data = False
     for line in f:
-      if line[0:5] == 'data_' and line.strip()[5:] in ['', 'particles']:
+      if 'data_model_classes' in line:
         data = True
         labels = []
       elif data and line[0] == '_':
         labels.append(line[line.find('_') + 1:line.find('#') - 1])
-      elif data and len(labels) > 0:
-        return labels
-      else:
-         continue 
+      elif data and '_'.join(os.path.split(star_file)[1].split('_')[:2]) in line:
+        resolutions.append(float(line.split()[labels.index('rlnEstimatedResolution')].replace('inf', '9999.99')))
+      elif 'data_model_class_1' in line:
+        break
+  return np.array(resolutions)
 
-def count_particles(star_files, sort_reso):
-  for star_file in sorted(star_files, key=lambda x: int(x[x.find('_it') + 3:x.find('_data.star')])): 
-    iteration = int(star_file[star_file.find('_it') + 3:star_file.find('_data.star')])
+def count_particles(star_files, sort_reso, nshards=None, partial_dir=None):
+  if partial_dir is not None:
+    counts = read_partials(star_files, nshards, partial_dir)
+  for star_file in sorted(star_files, key=get_iteration): 
+    iteration = get_iteration(star_file)
     classes = {}
     labels = read_headers(star_file)
     n = labels.index('rlnClassNumber')
-    with open(star_file) as f:
-      data = False
-      for line in f:
-        if data and line.strip() != '':
-          items = line.split()
-          try:
-            classes[int(items[n])] +=1
-          except KeyError:
-            classes[int(items[n])] = 1
-        elif line.startswith('_' + labels[-1]):
-          data = True
-        else:
-          continue
+    if partial_dir is not None:
+      try:
+        classes = counts[star_file]
+      except KeyError:
+        sys.exit('Sorry no results for {} in {}'.format(star_file, partial_dir))
+    elif star_file.endswith('.parquet'):
+      cls, n_ptcls = class_counts({labels[n]:read_parquet(star_file).read(columns=[labels[n]]).column(0).to_numpy()})
+      classes = dict(zip(cls.tolist(), n_ptcls.tolist()))
+    else:
+      with open(star_file) as f:
+        classes = count_lines(data_lines(f, labels), n)
 
-    total = 0
-    with open(star_file.replace('data','model'), 'r') as f:
-      cls = 0
-      data = False
-      for line in f:
-        if 'data_model_classes' in line:
-          data = True
-          labels = []
-        elif data and line[0] == '_':
-          labels.append(line[line.find('_') + 1:line.find('#') - 1])
-        elif data and '_'.join(os.path.split(star_file)[1].split('_')[:2]) in line:
-          cls += 1
-          try:
-            classes[cls] = (classes[cls], float(line.split()[labels.index('rlnEstimatedResolution')].replace('inf', '9999.99')))
-          except KeyError:
-            classes[cls] = (0, 9999.99) 
-        elif 'data_model_class_1' in line:
-          break
+    for cls, res in enumerate(class_resolutions(star_file).tolist(), 1):
+      classes[cls] = (classes[cls], res) if cls in classes else (0, 9999.99)
 
     print('Itn {:3d} Class #ptcls  Resn'.format(iteration))
     unclassified = 0
@@ -81,6 +126,7 @@ if __name__ == '__main__':
                       help='list of star files (use * or ?? to match multiple files')
   parser.add_argument('--reso', required=False, default=False, action='store_true',
                       help='sort classes by resolution (instead of by No. of particles)')
+  add_shard_arguments(parser)
   args = parser.parse_args()
   try:
     args.star_files.remove('run_it000_data.star') # classes > nclass
@@ -90,4 +136,15 @@ if __name__ == '__main__':
     sys.exit('Error: incorrect wildcard specified')
   if len([f for f in args.star_files if 'data' in f]) != len(args.star_files):
     sys.exit('Error: You need to give a list of run_itNNN_data files')
-  count_particles(star_files=args.star_files, sort_reso=args.reso)
+  check_shard_arguments(args, args.star_files)
+  if args.shard is not None:
+    count_shard(args.star_files, args.shard - 1, args.nshards, args.partial_dir)
+  elif args.reduce:
+    count_particles(star_files=args.star_files, sort_reso=args.reso, nshards=args.nshards, partial_dir=args.partial_dir)
+  elif args.nproc is not None and args.nproc > 1 and len([f for f in args.star_files if f.endswith('.parquet')]) == 0:
+    with tempfile.TemporaryDirectory() as partial_dir:
+      with Pool(args.nproc) as pool:
+        pool.starmap(count_shard, [(args.star_files, shard, args.nproc, partial_dir) for shard in range(args.nproc)])
+      count_particles(star_files=args.star_files, sort_reso=args.reso, nshards=args.nproc, partial_dir=partial_dir)
+  else:
+    count_particles(star_files=args.star_files, sort_reso=args.reso)
@@ -1,84 +1,156 @@
 #! /usr/bin/env python
 # Count particles in groups in RELION star file. Author Huw Jenkins 2019
 # Better header reading 02.04.21
+# Read from stdin with - and pass the star file through to stdout 19.10.26
+# group_counts() for columns already loaded by another script 19.10.26
 from __future__ import print_function
 import os
 import sys
+import json
 import argparse
+import tempfile
+from contextlib import ExitStack
+from multiprocessing import Pool
+import numpy as np
+from star_io import read_parquet, open_star, read_star, read_headers, pass_lines, shard_lines, partial_name, add_shard_arguments, check_shard_arguments
 
-def read_headers(star_file):
-  got_labels = False
-  data = False
-  in_loop = False
-  with open(star_file) as f:
-    for line in f:
-      if line[0:5] == 'data_' and line.strip()[5:] in ['', 'particles']:
-        data = True
-        labels = []
-      elif data and line[0] == '_':
-        labels.append(line[line.find('_') + 1:line.find('#') - 1])
-      elif data and len(labels) > 0:
-        return labels
-      else:
-         continue 
+BUFFER_SIZE = 1 << 20
 
-def count_group(star_file, output_file, cutoff):
-  groups = {}
-  mics = {}
-  regrouped = False
-  labels = read_headers(star_file)
+def group_columns(labels):
   try:
-    mic, n = labels.index('rlnMicrographName'), labels.index('rlnGroupNumber')
+    return labels.index('rlnMicrographName'), labels.index('rlnGroupNumber'), False
   except ValueError:
-    mic, n = labels.index('rlnMicrographName'), labels.index('rlnGroupName')
-    regrouped = True
+    return labels.index('rlnMicrographName'), labels.index('rlnGroupName'), True
+
+def count_lines(lines, mic, n, regrouped, groups, mics):
   total = 0
-  with open(star_file) as f:
-    data = False
-    for line in f:
-      if data and line.strip() != '':
-        items = line.split()
-        try:
-          if not regrouped:
-            groups[int(items[n])] +=1
-          else:
-            groups[items[n]] +=1
-          total += 1
-        except KeyError:
-          if not regrouped:
-            groups[int(items[n])] = 1
-            mics[int(items[n])] = items[mic].split('/')[-1]
-          else:
-            groups[items[n]] = 1
-          total += 1
-      elif line.startswith('_' + labels[-1]):
-        data = True
+  for line in lines:
+    items = line.split()
+    try:
+      if not regrouped:
+        groups[int(items[n])] +=1
+      else:
+        groups[items[n]] +=1
+      total += 1
+    except KeyError:
+      if not regrouped:
+        groups[int(items[n])] = 1
+        mics[int(items[n])] = items[mic].split('/')[-1]
       else:
-        continue
+        groups[items[n]] = 1
+      total += 1
+  return total
 
+def count_shard(star_file, shard, nshards, partial_dir):
+  # map step: counts for one byte range of the data block
+  labels = read_headers(star_file)
+  mic, n, regrouped = group_columns(labels)
+  groups = {}
+  mics = {}
+  total = count_lines(shard_lines(star_file, labels, shard, nshards), mic, n, regrouped, groups, mics)
+  with open(partial_name(partial_dir, 'count_group', star_file, shard, nshards, 'json'), 'w') as f:
+    json.dump({'total':total, 'groups':[(grp, groups[grp], mics.get(grp)) for grp in groups]}, f)
+
+def group_counts(columns):
+  # Particles in each group from already loaded columns ({label: numpy array}) ordered by decreasing
+  # count then first appearance. Returns the groups, their counts and the micrograph of the first
+  # particle in each group.
+  groups = columns['rlnGroupNumber'] if 'rlnGroupNumber' in columns else columns['rlnGroupName']
+  keys, first, counts = np.unique(groups, return_index=True, return_counts=True)
+  order = np.lexsort((first, -counts))
+  mics = np.array([mic.split('/')[-1] for mic in columns['rlnMicrographName'][first[order]]], dtype=object)
+  return keys[order], counts[order], mics
+
+def sort_groups(groups, mics):
+  # the dictionaries filled in by count_lines as arrays ordered as group_counts
+  keys = list(groups)
+  counts = np.array([groups[grp] for grp in keys], dtype=np.int64)
+  order = np.argsort(-counts, kind='stable')
+  return np.array(keys)[order], counts[order], np.array([mics.get(grp) for grp in keys], dtype=object)[order]
+
+def print_groups(groups, counts, mics, regrouped, out=sys.stdout):
+  total = int(counts.sum())
   running_total = 0
-  print('Group   #ptcls    total  Micrograph')
-  reject = []
-  for grp in (sorted(groups.items(), key=lambda x: x[1],reverse=True)):
+  print('Group   #ptcls    total  Micrograph', file=out)
+  for grp, n, mic in zip(groups.tolist(), counts.tolist(), mics):
     if not regrouped:
-      print('{:<5d} {:8d} {:8d}  {}'.format(grp[0], groups[grp[0]], total - running_total, mics[grp[0]]))
-      if cutoff is not None and groups[grp[0]] < cutoff:
-          reject.append(mics[grp[0]])
+      print('{:<5d} {:8d} {:8d}  {}'.format(grp, n, total - running_total, mic), file=out)
     else:
-      print('{} {:8d} {:8d}'.format(grp[0], groups[grp[0]], total - running_total))
-    running_total += groups[grp[0]]
-  if cutoff is not None and len(reject) > 0:
-    print ('Writing micrographs with fewer than {} particles to {}'.format(cutoff, output_file))
-    with open(output_file, 'w') as f:
+      print('{} {:8d} {:8d}'.format(grp, n, total - running_total), file=out)
+    running_total += n
+
+def count_group(star_file, output_file, cutoff, nshards=None, partial_dir=None, pass_through=False):
+  # the table goes to stderr when stdout is used for the star file or the reject list
+  out = sys.stderr if pass_through or output_file == '-' else sys.stdout
+  if partial_dir is not None or star_file.endswith('.parquet'):
+    labels = read_headers(star_file)
+    mic, n, regrouped = group_columns(labels)
+  if partial_dir is not None:
+    # reduce step: merging in shard order keeps the order of first appearance
+    groups = {}
+    mics = {}
+    for shard in range(nshards):
+      try:
+        with open(partial_name(partial_dir, 'count_group', star_file, shard, nshards, 'json')) as f:
+          partial = json.load(f)
+      except IOError:
+        sys.exit('Sorry could not find results for shard {} of {} in {}'.format(shard + 1, nshards, partial_dir))
+      for grp, count, m in partial['groups']:
+        groups[grp] = groups.get(grp, 0) + count
+        if m is not None and grp not in mics:
+          mics[grp] = m
+    groups, counts, mics = sort_groups(groups, mics)
+  elif star_file.endswith('.parquet'):
+    table = read_parquet(star_file).read(columns=[labels[mic], labels[n]])
+    groups, counts, mics = group_counts({label:table.column(label).to_numpy() for label in table.column_names})
+  else:
+    groups = {}
+    mics = {}
+    with ExitStack() as stack:
+      header, labels, lines = read_star(stack.enter_context(open_star(star_file)))
+      mic, n, regrouped = group_columns(labels)
+      if pass_through:
+        sys.stdout.flush()
+        fout = stack.enter_context(open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE, closefd=False))
+        fout.writelines(header)
+        lines = pass_lines(lines, fout)
+      count_lines(lines, mic, n, regrouped, groups, mics)
+    groups, counts, mics = sort_groups(groups, mics)
+
+  print_groups(groups, counts, mics, regrouped, out)
+  reject = mics[counts < cutoff].tolist() if cutoff is not None and not regrouped else []
+  if len(reject) > 0:
+    print ('Writing micrographs with fewer than {} particles to {}'.format(cutoff, output_file), file=out)
+    with open(output_file, 'w') if output_file != '-' else open(sys.stdout.fileno(), 'w', closefd=False) as f:
       for mic in reject:
         f.write(mic+'\n')
+
 if __name__=='__main__':
   parser = argparse.ArgumentParser(description='Count number of particles in each group (micrograph)')
   parser.add_argument('star_file', metavar='[run_data.star, shiny.star, particles_ctf_refine.star]', type=str,
-                      help='star file')
+                      help='star file (- for stdin)')
   parser.add_argument('--cutoff', required=False, default=None, metavar='50', type=int,
                       help='write list of micrographs with fewer than this many particles')
   parser.add_argument('--output', required=False, default='reject.txt', metavar='reject.txt', type=str,
-                      help='output file_name')
+                      help='output file_name (- for stdout)')
+  parser.add_argument('--pass_through', required=False, default=False, action='store_true',
+                      help='write the star file on to stdout (for piping to the next program) and the table to stderr')
+  add_shard_arguments(parser)
   args = parser.parse_args()
-  count_group(star_file=args.star_file, output_file=args.output, cutoff=args.cutoff)
+  if args.pass_through and args.cutoff is not None and args.output == '-':
+    sys.exit('Error: --pass_through uses stdout for the star file - give --output a file name')
+  if args.star_file == '-' or args.pass_through:
+    if args.shard is not None or args.reduce or args.nproc is not None or args.star_file.endswith('.parquet'):
+      sys.exit('Error: reading from stdin and --pass_through need a single pass over a star file')
+  check_shard_arguments(args, [args.star_file])
+  if args.shard is not None:
+    count_shard(args.star_file, args.shard - 1, args.nshards, args.partial_dir)
+  elif args.reduce:
+    count_group(star_file=args.star_file, output_file=args.output, cutoff=args.cutoff, nshards=args.nshards, partial_dir=args.partial_dir)
+  elif args.nproc is not None and args.nproc > 1 and not args.star_file.endswith('.parquet'):
+    with tempfile.TemporaryDirectory() as partial_dir:
+      with Pool(args.nproc) as pool:
+        pool.starmap(count_shard, [(args.star_file, shard, args.nproc, partial_dir) for shard in range(args.nproc)])
+      count_group(star_file=args.star_file, output_file=args.output, cutoff=args.cutoff, nshards=args.nproc, partial_dir=partial_dir)
+  else:
+    count_group(star_file=args.star_file, output_file=args.output, cutoff=args.cutoff, pass_through=args.pass_through)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# Flag micrographs where the refined defocus of the particles disagrees with the CTFFIND estimate. 19.10.26
+# Joins run_data.star (or particles_ctf_refine.star) to micrographs_ctf.star on _rlnMicrographName reading each file once.
+from __future__ import print_function
+import sys
+import argparse
+from itertools import islice
+import numpy as np
+from star_io import read_parquet, open_star, read_star
+
+CHUNK_SIZE = 100000 # particles converted at a time
+
+def read_micrographs(star_file):
+  # header, data lines (kept to write the outlier star files) and CTFFIND values of every micrograph
+  with open(star_file) as f:
+    header, labels, lines = read_star(f, ['', 'micrographs'])
+    lines = list(lines)
+  for label in ['rlnMicrographName', 'rlnDefocusU', 'rlnDefocusV', 'rlnCtfMaxResolution']:
+    if label not in labels:
+      sys.exit('Sorry could not find _{} in {}'.format(label, star_file))
+  m = labels.index('rlnMicrographName')
+  index = [labels.index('rlnDefocusU'), labels.index('rlnDefocusV'), labels.index('rlnCtfMaxResolution')]
+  items = [line.split() for line in lines]
+  names = [item[m] for item in items]
+  values = np.array([[item[i] for i in index] for item in items], dtype=float).reshape(-1, 3)
+  return header, lines, names, (values[:, 0] + values[:, 1]) / 2.0, values[:, 2]
+
+def micrograph_index(names):
+  # Integer id for each micrograph name. Particles are matched on the full name, or on the file name
+  # alone if that is unique, for particles that were re-extracted from a copy of the micrographs.
+  index = {name:i for i, name in enumerate(names)}
+  basenames = {}
+  for i, name in enumerate(names):
+    basename = name.split('/')[-1]
+    basenames[basename] = i if basename not in basenames else -1
+  for basename, i in basenames.items():
+    if i >= 0 and basename not in index:
+      index[basename] = i
+  return index
+
+def lookup(index, name):
+  # names that are not in the index are looked up by file name once and then remembered
+  i = index.get(name)
+  if i is None:
+    i = index[name] = index.get(name.split('/')[-1], -1)
+  return i
+
+def particle_chunks(star_file, chunk_size):
+  # (micrograph names, defocus U, defocus V) for blocks of particles
+  if star_file.endswith('.parquet'):
+    pf = read_parquet(star_file)
+    for batch in pf.iter_batches(batch_size=chunk_size, columns=['rlnMicrographName', 'rlnDefocusU', 'rlnDefocusV']):
+      yield batch.column(0).to_pylist(), batch.column(1).to_numpy(), batch.column(2).to_numpy()
+    return
+  with open_star(star_file) as f:
+    header, labels, lines = read_star(f)
+    for label in ['rlnMicrographName', 'rlnDefocusU', 'rlnDefocusV']:
+      if label not in labels:
+        sys.exit('Sorry could not find _{} in {}'.format(label, star_file))
+    m, u, v = labels.index('rlnMicrographName'), labels.index('rlnDefocusU'), labels.index('rlnDefocusV')
+    while True:
+      items = [line.split() for line in islice(lines, chunk_size)]
+      if len(items) == 0:
+        return
+      yield [item[m] for item in items], np.array([item[u] for item in items], dtype=float), np.array([item[v] for item in items], dtype=float)
+
+def join_particles(star_file, index, estimate):
+  # Per micrograph number of particles, mean and standard deviation of refined - estimated defocus
+  # accumulated with bincount so nothing per particle is kept
+  n_mics = len(estimate)
+  counts = np.zeros(n_mics)
+  sums = np.zeros(n_mics)
+  squares = np.zeros(n_mics)
+  n_particles = 0
+  unmatched = 0
+  for names, u, v in particle_chunks(star_file, CHUNK_SIZE):
+    ids = np.fromiter((lookup(index, name) for name in names), dtype=np.int64, count=len(names))
+    matched = ids >= 0
+    ids = ids[matched]
+    delta = (u[matched] + v[matched]) / 2.0 - estimate[ids]
+    counts += np.bincount(ids, minlength=n_mics)
+    sums += np.bincount(ids, weights=delta, minlength=n_mics)
+    squares += np.bincount(ids, weights=delta * delta, minlength=n_mics)
+    n_particles += len(names)
+    unmatched += int((~matched).sum())
+  with np.errstate(invalid='ignore', divide='ignore'):
+    mean = sums / counts
+    spread = np.sqrt(np.maximum(squares / counts - mean * mean, 0.0))
+  return counts.astype(int), mean, spread, n_particles, unmatched
+
+def find_outliers(counts, delta, spread, resolution, nsigma, max_spread, max_res, min_particles):
+  # Defocus outliers are judged against the median delta with a robust sigma from the MAD
+  # since a constant offset between refined and CTFFIND defocus is normal. When more than half of the
+  # deltas are the same the MAD is 0 and the mean absolute deviation from the median is used instead.
+  used = counts >= min_particles
+  reasons = [[] for i in range(len(counts))]
+  if used.any():
+    centre = np.median(delta[used])
+    sigma = 1.4826 * np.median(np.abs(delta[used] - centre))
+    if sigma == 0.0:
+      sigma = 1.2533 * np.mean(np.abs(delta[used] - centre))
+    for i in np.flatnonzero(used & (np.abs(delta - centre) > nsigma * sigma)):
+      reasons[i].append('delta')
+  else:
+    centre, sigma = 0.0, 0.0
+  if max_spread is not None:
+    for i in np.flatnonzero(used & (spread > max_spread)):
+      reasons[i].append('spread')
+  if max_res is not None:
+    for i in np.flatnonzero(resolution > max_res):
+      reasons[i].append('resolution')
+  return reasons, centre, sigma
+
+def write_star(star_file, header, lines):
+  with open(star_file, 'w') as f:
+    f.writelines(header)
+    f.writelines(lines)
+
+def defocus_outliers(particles_file, micrographs_file, output, output_star, good_star, nsigma, max_spread, max_res, min_particles):
+  print('Reading micrographs from {}...'.format(micrographs_file))
+  header, lines, names, estimate, resolution = read_micrographs(micrographs_file)
+  index = micrograph_index(names)
+  print('Reading particles from {}...'.format(particles_file))
+  counts, delta, spread, n_particles, unmatched = join_particles(particles_file, index, estimate)
+  print('{} particles on {} of {} micrographs'.format(n_particles - unmatched, int((counts > 0).sum()), len(names)))
+  if unmatched > 0:
+    print('WARNING {} particles are on micrographs that are not in {}'.format(unmatched, micrographs_file))
+  reasons, centre, sigma = find_outliers(counts, delta, spread, resolution, nsigma, max_spread, max_res, min_particles)
+  print('Median refined - CTFFIND defocus {:.1f} A, robust sigma {:.1f} A'.format(centre, sigma))
+
+  outliers = [i for i in range(len(names)) if len(reasons[i]) > 0]
+  outliers.sort(key=lambda i: -abs(delta[i] - centre) if counts[i] > 0 else 0.0)
+  print('Micrograph                                                         #ptcls    CTFFIND    delta   spread  CTF res  flagged')
+  for i in outliers:
+    print('{:<66s} {:6d} {:10.1f} {:8.1f} {:8.1f} {:8.2f}  {}'.format(names[i].split('/')[-1], counts[i], estimate[i], delta[i], spread[i], resolution[i], ','.join(reasons[i])))
+  print('{} outlier micrographs'.format(len(outliers)))
+  with open(output, 'w') as f:
+    for i in outliers:
+      f.write(names[i] + '\n')
+  print('Writing outlier micrographs to {} and {}'.format(output, output_star))
+  flagged = set(outliers)
+  write_star(output_star, header, [line for i, line in enumerate(lines) if i in flagged])
+  if good_star is not None:
+    print('Writing the other {} micrographs to {}'.format(len(names) - len(outliers), good_star))
+    write_star(good_star, header, [line for i, line in enumerate(lines) if i not in flagged])
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description='Flag micrographs where refined particle defocus disagrees with the CTFFIND estimate')
+  parser.add_argument('particles_file', metavar='run_data.star', type=str,
+                      help='star file with refined CTF parameters (or run_data_particles.parquet from star_to_parquet.py, - for stdin)')
+  parser.add_argument('micrographs_file', metavar='micrographs_ctf.star', type=str,
+                      help='star file from CtfFind')
+  parser.add_argument('--output', required=False, default='outliers.txt', metavar='outliers.txt', type=str,
+                      help='list of outlier micrographs')
+  parser.add_argument('--output_star', required=False, default='outliers.star', metavar='outliers.star', type=str,
+                      help='outlier micrographs as a subset of micrographs_ctf.star')
+  parser.add_argument('--good_star', required=False, default=None, metavar='micrographs_good.star', type=str,
+                      help='also write the micrographs that are not outliers to this star file')
+  parser.add_argument('--nsigma', required=False, default=4.0, metavar='4', type=float,
+                      help='flag micrographs whose mean refined - CTFFIND defocus is further than this many (robust) sigma from the median')
+  parser.add_argument('--max_spread', required=False, default=None, metavar='500', type=float,
+                      help='flag micrographs where the standard deviation of particle defocus is larger than this (A)')
+  parser.add_argument('--max_res', required=False, default=None, metavar='6', type=float,
+                      help='flag micrographs with CTF maximum resolution worse than this (A)')
+  parser.add_argument('--min_particles', required=False, default=5, metavar='5', type=int,
+                      help='only judge defocus on micrographs with at least this many particles')
+  args = parser.parse_args()
+  if args.micrographs_file == '-' or args.micrographs_file.endswith('.parquet'):
+    sys.exit('Error: micrographs_ctf.star has to be a star file so that the outliers can be written as a star file')
+  defocus_outliers(args.particles_file, args.micrographs_file, args.output, args.output_star, args.good_star,
+                   args.nsigma, args.max_spread, args.max_res, args.min_particles)
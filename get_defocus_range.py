@@ -1,73 +1,149 @@
 #! /usr/bin/env python
 # Get median defocus for particles per micrograph in RELION star file. Author Huw Jenkins 2020
 # Better header reading 02.04.21
+# Read from stdin with - and pass the star file through to stdout 19.10.26
+# micrograph_defocus() and defocus_summary() for columns already loaded by another script 19.10.26
 from __future__ import print_function
 import os
 import sys
 import argparse
+import tempfile
+from contextlib import ExitStack
+from multiprocessing import Pool
 import numpy as np
+from star_io import read_parquet, open_star, read_star, read_headers, pass_lines, shard_lines, partial_name, add_shard_arguments, check_shard_arguments
 
-def read_headers(star_file):
-  got_labels = False
-  data = False
-  in_loop = False
-  with open(star_file) as f:
-    for line in f:
-      if line[0:5] == 'data_' and line.strip()[5:] in ['', 'particles']:
-        data = True
-        labels = []
-      elif data and line[0] == '_':
-        labels.append(line[line.find('_') + 1:line.find('#') - 1])
-      elif data and len(labels) > 0:
-        return labels
-      else:
-         continue 
+BUFFER_SIZE = 1 << 20
 
-def print_defocus_range(star_file, cutoff):
+def read_lines(lines, m, u, v, results):
+  for line in lines:
+    items = line.split()
+    try:
+      results[items[m].split('/')[-1]]['defocusU_results'].append(float(items[u]))
+      results[items[m].split('/')[-1]]['defocusV_results'].append(float(items[v]))
+    except KeyError:
+      results[items[m].split('/')[-1]] = {'defocusU_results':[float(items[u])]}
+      results[items[m].split('/')[-1]].update({'defocusV_results':[float(items[v])]})
+
+def defocus_shard(star_file, shard, nshards, partial_dir):
+  # Map step. Unlike the counts of the other scripts these partials cannot be summaries: an exact median and the
+  # number above --cutoff (only given to the reduce step) need every value. Each shard keeps one mean defocus per
+  # particle, grouped by micrograph.
   results = {}
   labels = read_headers(star_file)
   m, u, v = labels.index('rlnMicrographName'), labels.index('rlnDefocusU'), labels.index('rlnDefocusV')
-  with open(star_file) as f:
-    data = False
-    for line in f:
-      if data and line.strip() != '':
-        items = line.split()
-        try:
-          results[items[m].split('/')[-1]]['defocusU_results'].append(float(items[u]))
-          results[items[m].split('/')[-1]]['defocusV_results'].append(float(items[v]))
-        except KeyError:
-          results[items[m].split('/')[-1]] = {'defocusU_results':[float(items[u])]}
-          results[items[m].split('/')[-1]].update({'defocusV_results':[float(items[v])]})
-      elif line.startswith('_' + labels[-1]):
-        data = True
-      else:
-        continue
+  read_lines(shard_lines(star_file, labels, shard, nshards), m, u, v, results)
+  mics = list(results)
+  np.savez(partial_name(partial_dir, 'get_defocus_range', star_file, shard, nshards, 'npz'),
+           mics=np.array(mics, dtype=str),
+           counts=np.array([len(results[mic]['defocusU_results']) for mic in mics], dtype=np.int64),
+           defocus=np.array([(du + dv) / 2.0 for mic in mics for du, dv in zip(results[mic]['defocusU_results'], results[mic]['defocusV_results'])]))
+
+def reduce_partials(star_file, nshards, partial_dir):
+  # Micrographs in order of first appearance and an array of the particle defocus on each, from the partials of all
+  # shards joined as numpy arrays
+  mics = []
+  counts = []
+  defocus = []
+  for shard in range(nshards):
+    try:
+      partial = np.load(partial_name(partial_dir, 'get_defocus_range', star_file, shard, nshards, 'npz'))
+    except IOError:
+      sys.exit('Sorry could not find results for shard {} of {} in {}'.format(shard + 1, nshards, partial_dir))
+    mics.append(partial['mics'])
+    counts.append(partial['counts'])
+    defocus.append(partial['defocus'])
+  names, first, index = np.unique(np.concatenate(mics), return_index=True, return_inverse=True)
+  order = np.argsort(first)
+  rank = np.empty_like(order)
+  rank[order] = np.arange(len(order))
+  index = np.repeat(rank[index], np.concatenate(counts))
+  s = np.argsort(index, kind='stable')
+  return names[order].tolist(), np.split(np.concatenate(defocus)[s], np.cumsum(np.bincount(index, minlength=len(names)))[:-1])
 
+def micrograph_defocus(columns):
+  # Micrograph file names (sorted) and an array of the particle defocus on each from already loaded
+  # columns ({label: numpy array})
+  mics, index = np.unique(columns['rlnMicrographName'], return_inverse=True)
+  mics, mic_index = np.unique([mic.split('/')[-1] for mic in mics], return_inverse=True)
+  index = mic_index[index]
+  order = np.argsort(index, kind='stable')
+  d = (columns['rlnDefocusU'] + columns['rlnDefocusV']) / 2.0
+  return mics.tolist(), np.split(d[order], np.cumsum(np.bincount(index))[:-1])
+
+def defocus_summary(mics, defocus, cutoff=None):
+  # median, mean and maximum defocus, number of particles (and number above cutoff) for each
+  # micrograph as a structured array ordered by median defocus
+  summary = np.zeros(len(mics), dtype=[('micrograph', object), ('median', float), ('mean', float), ('max', float),
+                                      ('particles', np.int64), ('above_cutoff', np.int64)])
+  for i, (mic, d) in enumerate(zip(mics, defocus)):
+    five_num = np.percentile(d, [0, 25, 50, 75, 100])
+    summary[i] = (mic, five_num[2], np.mean(d), five_num[4], d.size, (d > cutoff).sum() if cutoff is not None else 0)
+  return summary[np.argsort(summary['median'], kind='stable')]
+
+def print_summary(summary, cutoff, out=sys.stdout):
   if cutoff is not None:
-    print('Micrograph                                                         median   mean     max      num > cutoff')
+    print('Micrograph                                                         median   mean     max      num > cutoff', file=out)
   else:
-    print('Micrograph                                                         median   mean     max      no. ptcls')
-  summary = {}
-  for mic in results:
-    d = (np.array(results[mic]['defocusU_results']) + np.array(results[mic]['defocusV_results']))/2.0
-    five_num = np.percentile(d, [0, 25, 50, 75, 100])
-    mean = np.mean(d)
-    
+    print('Micrograph                                                         median   mean     max      no. ptcls', file=out)
+  for row in summary:
     if cutoff is not None:
-      summary.update({mic:[five_num[2],mean,five_num[4],(d>cutoff).sum(), d.size]})
+      print(row['micrograph'], '{:8.1f} {:8.1f} {:8.1f} {:4d}/{:4d}'.format(row['median'], row['mean'], row['max'], row['above_cutoff'], row['particles']), file=out)
     else:
-      summary.update({mic:[five_num[2],mean,five_num[4],d.size]})
-  for mic in sorted(summary.items(), key=lambda x: x[1][0]):
-    if cutoff is not None:
-      print(mic[0], '{:8.1f} {:8.1f} {:8.1f} {:4d}/{:4d}'.format(mic[1][0],mic[1][1],mic[1][2],mic[1][3],mic[1][4]))
-    else:
-      print(mic[0], '{:8.1f} {:8.1f} {:8.1f} {:4d}'.format(mic[1][0],mic[1][1],mic[1][2],mic[1][3]))
+      print(row['micrograph'], '{:8.1f} {:8.1f} {:8.1f} {:4d}'.format(row['median'], row['mean'], row['max'], row['particles']), file=out)
+
+def print_defocus_range(star_file, cutoff, nshards=None, partial_dir=None, pass_through=False):
+  results = {}
+  out = sys.stderr if pass_through else sys.stdout
+  if partial_dir is not None or star_file.endswith('.parquet'):
+    labels = read_headers(star_file)
+    m, u, v = labels.index('rlnMicrographName'), labels.index('rlnDefocusU'), labels.index('rlnDefocusV')
+  if partial_dir is not None:
+    # reduce step
+    mics, defocus = reduce_partials(star_file, nshards, partial_dir)
+    print_summary(defocus_summary(mics, defocus, cutoff), cutoff, out)
+    return
+  elif star_file.endswith('.parquet'):
+    table = read_parquet(star_file).read(columns=[labels[m], labels[u], labels[v]])
+    mics, defocus = micrograph_defocus({label:table.column(label).to_numpy() for label in table.column_names})
+    print_summary(defocus_summary(mics, defocus, cutoff), cutoff, out)
+    return
+  else:
+    with ExitStack() as stack:
+      header, labels, lines = read_star(stack.enter_context(open_star(star_file)))
+      m, u, v = labels.index('rlnMicrographName'), labels.index('rlnDefocusU'), labels.index('rlnDefocusV')
+      if pass_through:
+        sys.stdout.flush()
+        fout = stack.enter_context(open(sys.stdout.fileno(), 'w', buffering=BUFFER_SIZE, closefd=False))
+        fout.writelines(header)
+        lines = pass_lines(lines, fout)
+      read_lines(lines, m, u, v, results)
+
+  defocus = [(np.array(results[mic]['defocusU_results']) + np.array(results[mic]['defocusV_results']))/2.0 for mic in results]
+  print_summary(defocus_summary(list(results), defocus, cutoff), cutoff, out)
 
 if __name__=='__main__':
   parser = argparse.ArgumentParser(description='Print per micrograph defocus spread')
   parser.add_argument('star_file', metavar='[run_data.star, particles_ctf_refine.star]', type=str,
-                      help='star file with refined CTF parameters')
+                      help='star file with refined CTF parameters (- for stdin)')
   parser.add_argument('--cutoff', required=False, default=None, metavar='15000', type=int,
                       help='write number of particles with defocus below this cutoff on each micrograph')
+  parser.add_argument('--pass_through', required=False, default=False, action='store_true',
+                      help='write the star file on to stdout (for piping to the next program) and the table to stderr')
+  add_shard_arguments(parser)
   args = parser.parse_args()
-  print_defocus_range(star_file=args.star_file, cutoff=args.cutoff)
+  if args.star_file == '-' or args.pass_through:
+    if args.shard is not None or args.reduce or args.nproc is not None or args.star_file.endswith('.parquet'):
+      sys.exit('Error: reading from stdin and --pass_through need a single pass over a star file')
+  check_shard_arguments(args, [args.star_file])
+  if args.shard is not None:
+    defocus_shard(args.star_file, args.shard - 1, args.nshards, args.partial_dir)
+  elif args.reduce:
+    print_defocus_range(star_file=args.star_file, cutoff=args.cutoff, nshards=args.nshards, partial_dir=args.partial_dir)
+  elif args.nproc is not None and args.nproc > 1 and not args.star_file.endswith('.parquet'):
+    with tempfile.TemporaryDirectory() as partial_dir:
+      with Pool(args.nproc) as pool:
+        pool.starmap(defocus_shard, [(args.star_file, shard, args.nproc, partial_dir) for shard in range(args.nproc)])
+      print_defocus_range(star_file=args.star_file, cutoff=args.cutoff, nshards=args.nproc, partial_dir=partial_dir)
+  else:
+    print_defocus_range(star_file=args.star_file, cutoff=args.cutoff, pass_through=args.pass_through)
@@ -0,0 +1,79 @@
+# Make-style up to date checks for plots, shared by plot_defocus.py, plot_fsc.py, plot_iterations.py, plot_topaz.py
+# and update_reports.py. output.manifest.json records the command, options and the size and modification time
+# (and with --checksum the SHA1) of every input when output was written. 19.10.26
+import os
+import sys
+import json
+import hashlib
+
+MANIFEST_IGNORE = ['output', 'force', 'checksum'] # options of every plotting script that do not change the plot
+
+def file_state(path, checksum=False):
+  state = {'path':os.path.abspath(path), 'size':os.path.getsize(path), 'mtime':os.path.getmtime(path)}
+  if checksum:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for block in iter(lambda: f.read(1 << 20), b''):
+        h.update(block)
+    state['sha1'] = h.hexdigest()
+  return state
+
+def read_manifest(output_file):
+  try:
+    with open(output_file + '.manifest.json') as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return None
+
+def inputs_unchanged(inputs):
+  # A changed modification time only counts if there is no checksum or the checksum differs. Returns whether
+  # the inputs are unchanged and whether any passed only on their checksum, in which case their new
+  # modification times are stored in inputs.
+  touched = False
+  for old in inputs:
+    try:
+      new = file_state(old['path'])
+    except OSError:
+      return False, False
+    if new['size'] != old['size']:
+      return False, False
+    if new['mtime'] != old['mtime']:
+      if 'sha1' not in old or file_state(old['path'], True)['sha1'] != old['sha1']:
+        return False, False
+      old['mtime'] = new['mtime']
+      touched = True
+  return True, touched
+
+def manifest_up_to_date(output_file, matches):
+  # output_file is up to date if matches(manifest) is true for its manifest, every file written with it still exists
+  # and none of the inputs recorded in it have changed. The manifest is rewritten when inputs were only touched so
+  # the next check does not need checksums.
+  manifest = read_manifest(output_file)
+  if manifest is None or not matches(manifest):
+    return False
+  if not all(os.path.isfile(path) for path in manifest.get('outputs', [os.path.abspath(output_file)])):
+    return False
+  unchanged, touched = inputs_unchanged(manifest['inputs'])
+  if unchanged and touched:
+    with open(output_file + '.manifest.json', 'w') as f:
+      json.dump(manifest, f, indent=1)
+  return unchanged
+
+def manifest_options(args, ignore=()):
+  # options that change the plot, in the form they are read back from the manifest. ignore is the inputs
+  # and any other options of the script that do not change the plot.
+  return json.loads(json.dumps({k:v for k, v in vars(args).items() if k not in MANIFEST_IGNORE + list(ignore)}))
+
+def up_to_date(output_file, inputs, options):
+  # Make-style check against output_file.manifest.json written with the last plot
+  inputs = [os.path.abspath(path) for path in inputs]
+  return manifest_up_to_date(output_file, lambda manifest: manifest.get('options') == options and inputs == [i['path'] for i in manifest['inputs']])
+
+def write_manifest(output_file, inputs, options, checksum, outputs=None):
+  # outputs are all the files written with output_file (default: just output_file)
+  command = [os.path.split(sys.argv[0])[1]] + [arg for arg in sys.argv[1:] if arg not in ['--force', '--checksum']]
+  manifest = {'output':os.path.abspath(output_file), 'outputs':[os.path.abspath(path) for path in outputs or [output_file]],
+              'command':command, 'options':options,
+              'inputs':[file_state(path, checksum) for path in inputs]}
+  with open(output_file + '.manifest.json', 'w') as f:
+    json.dump(manifest, f, indent=1)
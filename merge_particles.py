@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# Merge particle star files (clean_edges.py output, Class3D selections, re-extractions) into one, removing duplicates. 19.10.26
+# Optics groups are renumbered so that identical groups are shared and different ones stay separate. Particles are
+# duplicates if they have the same _rlnImageName or with --tolerance are this close to an earlier particle that is kept on the same micrograph.
+from __future__ import print_function
+import sys
+import argparse
+import hashlib
+from contextlib import ExitStack
+from itertools import islice
+import numpy as np
+from star_io import read_star
+
+CHUNK_SIZE = 100000 # particles compared and written at a time
+BUFFER_SIZE = 1 << 20
+
+def read_optics(lines):
+  # labels and rows of the data_optics block of the header lines
+  labels = []
+  rows = []
+  data = False
+  for line in lines:
+    if line[0:5] == 'data_':
+      data = line.strip() == 'data_optics'
+    elif data and line[0] == '_':
+      labels.append(line[line.find('_') + 1:line.find('#') - 1])
+    elif data and len(labels) > 0 and line.strip() != '' and line[0] != '#':
+      rows.append(line.split())
+  return labels, rows
+
+def star_version(lines):
+  for line in lines:
+    if line.startswith('# version'):
+      return line
+  return None
+
+def optics_key(labels, row):
+  # optics groups are the same if everything but the group number is, compared as numbers where possible
+  key = []
+  for label, value in zip(labels, row):
+    if label == 'rlnOpticsGroup':
+      continue
+    try:
+      key.append((label, float(value)))
+    except ValueError:
+      key.append((label, value))
+  return tuple(sorted(key))
+
+def merge_optics(optics, star_files):
+  # Merged optics labels and rows, and {old group: new group} for each star file. Groups from
+  # different files that match share a number, groups from the same file are never merged.
+  labels = optics[0][0]
+  rows = []
+  numbers = {}
+  names = set()
+  mappings = []
+  for (file_labels, file_rows), star_file in zip(optics, star_files):
+    if sorted(file_labels) != sorted(labels):
+      sys.exit('Sorry the optics table of {} has different columns to {}'.format(star_file, star_files[0]))
+    mapping = {}
+    used = set()
+    for row in file_rows:
+      values = dict(zip(file_labels, row))
+      old = int(values['rlnOpticsGroup'])
+      key = optics_key(file_labels, row)
+      if key in numbers and numbers[key] not in used:
+        g = numbers[key]
+      else:
+        g = len(rows) + 1
+        numbers.setdefault(key, g)
+        values['rlnOpticsGroup'] = str(g)
+        if 'rlnOpticsGroupName' in values:
+          if values['rlnOpticsGroupName'] in names:
+            values['rlnOpticsGroupName'] = 'opticsGroup{}'.format(g)
+          names.add(values['rlnOpticsGroupName'])
+        rows.append([values[label] for label in labels])
+      used.add(g)
+      mapping[old] = g
+    mappings.append(mapping)
+  return labels, rows, mappings
+
+def write_header(f, version, optics_labels, optics_rows, labels):
+  if len(optics_labels) > 0:
+    f.write('\n{}\ndata_optics\n\nloop_ \n'.format(version or ''))
+    f.writelines('_{} #{} \n'.format(label, i) for i, label in enumerate(optics_labels, 1))
+    f.writelines(' '.join(row) + ' \n' for row in optics_rows)
+    f.write(' \n\n{}\ndata_particles\n\nloop_ \n'.format(version or ''))
+  else:
+    f.write('\n{}\ndata_\n\nloop_ \n'.format(version or ''))
+  f.writelines('_{} #{} \n'.format(label, i) for i, label in enumerate(labels, 1))
+
+def add_to_index(index, columns):
+  # index is a tuple of arrays sorted on the first. The existing index is already sorted so a stable sort
+  # of the two runs is a merge.
+  columns = [np.concatenate((a, b)) for a, b in zip(index, columns)]
+  order = np.argsort(columns[0], kind='stable')
+  return tuple(c[order] for c in columns)
+
+def name_hashes(names):
+  # 64 bit digests of the names that are the same in every run (hash() of a str is not)
+  return np.fromiter((int.from_bytes(hashlib.blake2b(name, digest_size=8).digest(), 'little', signed=True) for name in names),
+                     dtype=np.int64, count=len(names))
+
+def image_duplicates(index, names, file_index):
+  # File of the earlier particle with the same image name for each particle (-1 if none) and the index
+  # updated with the new names. The index is sorted on digests of the names for fast searching and the
+  # names themselves are compared wherever the digests match.
+  names = np.array([name.encode() for name in names], dtype=bytes)
+  hashes = name_hashes(names)
+  keys, files, known = index
+  partner = np.full(len(hashes), -1, dtype=np.int64)
+  lo = np.searchsorted(keys, hashes, side='left')
+  hi = np.searchsorted(keys, hashes, side='right')
+  for j in range(int((hi - lo).max(initial=0))):
+    rows = np.flatnonzero((lo + j < hi) & (partner < 0))
+    i = lo[rows] + j
+    same = known[i] == names[rows]
+    partner[rows[same]] = files[i[same]]
+  unique, first = np.unique(names, return_index=True)
+  repeated = np.ones(len(names), dtype=bool)
+  repeated[first] = False
+  partner[repeated & (partner < 0)] = file_index
+  new = first[partner[first] < 0]
+  return partner, add_to_index(index, (hashes[new], np.full(len(new), file_index, dtype=np.int16), names[new]))
+
+CELL_BITS = 21 # bits for each of micrograph, grid cell x and grid cell y in a grid key
+CELL_OFFSET = 1 << (CELL_BITS - 1) # so cells of negative coordinates have positive numbers
+
+def grid_keys(mics, x, y, tolerance):
+  # micrograph and grid cell (of side tolerance) packed into one integer. Cell numbers are kept at least one
+  # away from the ends of their field so the key of a neighbouring cell is always key + (dx << CELL_BITS) + dy.
+  ix = np.floor(x / tolerance).astype(np.int64) + CELL_OFFSET
+  iy = np.floor(y / tolerance).astype(np.int64) + CELL_OFFSET
+  limit = (1 << CELL_BITS) - 1
+  if len(mics) > 0 and mics.max() >= limit:
+    sys.exit('Sorry too many micrographs to compare coordinates (at most {})'.format(limit))
+  if len(x) > 0 and (min(ix.min(), iy.min()) < 1 or max(ix.max(), iy.max()) >= limit):
+    sys.exit('Sorry coordinates from {:.0f} to {:.0f} are too large for --tolerance {}'.format(min(x.min(), y.min()), max(x.max(), y.max()), tolerance))
+  return (mics << (2 * CELL_BITS)) | (ix << CELL_BITS) | iy
+
+def near_pairs(keys, ix, iy, key, x, y, tolerance):
+  # (particle, index row) for every pair closer than tolerance, searching the 3 x 3 grid cells around each particle
+  # of key, x and y in the index sorted on keys
+  particles = []
+  rows = []
+  for dx in (-1, 0, 1):
+    for dy in (-1, 0, 1):
+      k = key + (dx << CELL_BITS) + dy
+      lo = np.searchsorted(keys, k, side='left')
+      hi = np.searchsorted(keys, k, side='right')
+      for j in range(int((hi - lo).max(initial=0))):
+        p = np.flatnonzero(lo + j < hi)
+        i = lo[p] + j
+        near = (ix[i] - x[p])**2 + (iy[i] - y[p])**2 < tolerance**2
+        particles.append(p[near])
+        rows.append(i[near])
+  return np.concatenate(particles + [np.zeros(0, dtype=np.intp)]), np.concatenate(rows + [np.zeros(0, dtype=np.intp)])
+
+def coordinate_duplicates(index, mics, x, y, file_index, tolerance):
+  # File of an earlier kept particle on the same micrograph closer than tolerance for each particle (-1 if none)
+  # and the index updated with the particles that are kept. The index only has kept particles so a particle is
+  # never removed for being close to one that was itself removed.
+  key = grid_keys(mics, x, y, tolerance)
+  keys, ix, iy, files = index
+  # searching for the particles in key order is much faster than in file order
+  s = np.argsort(key, kind='stable')
+  partner = np.full(len(x), -1, dtype=np.int64)
+  p, i = near_pairs(keys, ix, iy, key[s], x[s], y[s], tolerance)
+  partner[s[p]] = files[i]
+  # particles close to an earlier particle of the same chunk are decided in file order
+  p, q = near_pairs(key[s], x[s], y[s], key[s], x[s], y[s], tolerance)
+  p, q = s[p], s[q]
+  earlier = q < p
+  p, q = p[earlier], q[earlier]
+  order = np.argsort(p, kind='stable')
+  for particle, neighbour in zip(p[order].tolist(), q[order].tolist()):
+    if partner[particle] < 0 and partner[neighbour] < 0:
+      partner[particle] = file_index
+  keep = partner < 0
+  return partner, add_to_index(index, (key[keep], x[keep], y[keep], np.full(int(keep.sum()), file_index, dtype=np.int16)))
+
+def merge_particles(star_files, output_file, report_file, tolerance=None, duplicates_file=None):
+  with ExitStack() as stack:
+    inputs = [read_star(stack.enter_context(open(star_file))) for star_file in star_files]
+    labels = inputs[0][1]
+    for star_file, (header, file_labels, lines) in zip(star_files, inputs):
+      missing = [label for label in labels if label not in file_labels]
+      if len(missing) > 0:
+        sys.exit('Sorry {} does not have {}'.format(star_file, ', '.join('_' + label for label in missing)))
+    if tolerance is None:
+      if 'rlnImageName' not in labels:
+        sys.exit('Sorry could not find _rlnImageName - give --tolerance to compare coordinates')
+      index = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int16), np.zeros(0, dtype=bytes))
+    else:
+      for label in ['rlnMicrographName', 'rlnCoordinateX', 'rlnCoordinateY']:
+        if label not in labels:
+          sys.exit('Sorry could not find _{} to compare coordinates'.format(label))
+      index = (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int16))
+      mic_ids = {}
+
+    optics = [read_optics(header) for header, file_labels, lines in inputs]
+    if len(set(len(o[0]) > 0 for o in optics)) > 1:
+      sys.exit('Sorry either all or none of the star files need an optics table')
+    optics_labels, optics_rows, mappings = merge_optics(optics, star_files) if len(optics[0][0]) > 0 else ([], [], [{} for sf in star_files])
+
+    fout = stack.enter_context(open(output_file, 'w', buffering=BUFFER_SIZE))
+    fdup = stack.enter_context(open(duplicates_file, 'w', buffering=BUFFER_SIZE)) if duplicates_file is not None else None
+    version = star_version(inputs[0][0])
+    write_header(fout, version, optics_labels, optics_rows, labels)
+    if fdup is not None:
+      write_header(fdup, version, optics_labels, optics_rows, labels)
+
+    n_files = len(star_files)
+    counts = np.zeros(n_files, dtype=np.int64)
+    overlaps = np.zeros((n_files, n_files), dtype=np.int64)
+    for file_index, (star_file, (header, file_labels, lines), mapping) in enumerate(zip(star_files, inputs, mappings)):
+      print('Reading particles from {}...'.format(star_file))
+      # lines are only rewritten if the columns or optics group numbers change
+      index_columns = [file_labels.index(label) for label in labels]
+      rewrite = file_labels != labels or any(old != new for old, new in mapping.items())
+      og = labels.index('rlnOpticsGroup') if 'rlnOpticsGroup' in labels else None
+      while True:
+        chunk = list(islice(lines, CHUNK_SIZE))
+        if len(chunk) == 0:
+          break
+        items = [line.split() for line in chunk]
+        if tolerance is None:
+          i = file_labels.index('rlnImageName')
+          partner, index = image_duplicates(index, [item[i] for item in items], file_index)
+        else:
+          m, xi, yi = file_labels.index('rlnMicrographName'), file_labels.index('rlnCoordinateX'), file_labels.index('rlnCoordinateY')
+          mics = np.fromiter((mic_ids.setdefault(item[m], len(mic_ids)) for item in items), dtype=np.int64, count=len(items))
+          xy = np.array([[item[xi], item[yi]] for item in items], dtype=float)
+          partner, index = coordinate_duplicates(index, mics, xy[:, 0], xy[:, 1], file_index, tolerance)
+        if rewrite:
+          chunk = []
+          for item in items:
+            values = [item[j] for j in index_columns]
+            if og is not None and len(mapping) > 0:
+              values[og] = str(mapping[int(values[og])])
+            chunk.append(' '.join(values) + '\n')
+        keep = partner < 0
+        fout.writelines(line for line, k in zip(chunk, keep) if k)
+        if fdup is not None:
+          fdup.writelines(line for line, k in zip(chunk, keep) if not k)
+        counts[file_index] += len(chunk)
+        overlaps[file_index] += np.bincount(partner[~keep], minlength=n_files)
+    fout.write('\n')
+    if fdup is not None:
+      fdup.write('\n')
+
+  duplicates = overlaps.sum(axis=1)
+  written = int(counts.sum() - duplicates.sum())
+  report = ['Merged {} star files into {}: {} particles written, {} duplicates removed ({})'.format(
+            n_files, output_file, written, int(duplicates.sum()),
+            'same _rlnImageName' if tolerance is None else 'within {} px on the same micrograph'.format(tolerance)), '']
+  report.append('File  particles  duplicates     written  Star file')
+  for i, star_file in enumerate(star_files):
+    report.append('{:4d} {:10d} {:11d} {:11d}  {}'.format(i + 1, counts[i], duplicates[i], counts[i] - duplicates[i], star_file))
+  report += ['', 'Duplicates in each file (rows) by the file of the earlier copy (columns)']
+  report.append('File ' + ''.join('{:>10d}'.format(j + 1) for j in range(n_files)))
+  for i in range(n_files):
+    report.append('{:4d} '.format(i + 1) + ''.join('{:10d}'.format(n) for n in overlaps[i]))
+  if len(optics_labels) > 0:
+    report += ['', 'Optics groups']
+    for i, mapping in enumerate(mappings):
+      report.append('{:4d}  '.format(i + 1) + ', '.join('{} -> {}'.format(old, new) for old, new in sorted(mapping.items())))
+  print('\n'.join(report))
+  with open(report_file, 'w') as f:
+    f.write('\n'.join(report) + '\n')
+  print('Writing the overlap report to {}'.format(report_file))
+  if duplicates_file is not None:
+    print('Writing {} duplicates to {}'.format(int(duplicates.sum()), duplicates_file))
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description='Merge particle star files renumbering optics groups and removing duplicate particles')
+  parser.add_argument('star_files', metavar='run_data.star', type=str, nargs='+',
+                      help='particle star files (the first copy of a duplicated particle is kept)')
+  parser.add_argument('--output', required=False, default='merged.star', metavar='merged.star', type=str,
+                      help='merged star file')
+  parser.add_argument('--report', required=False, default='merge_report.txt', metavar='merge_report.txt', type=str,
+                      help='number of particles and duplicates from each star file')
+  parser.add_argument('--tolerance', required=False, default=None, metavar='10', type=float,
+                      help='particles are duplicates if they are closer than this (in micrograph px) on the same micrograph (default: same _rlnImageName)')
+  parser.add_argument('--duplicates_file', required=False, default=None, metavar='duplicates.star', type=str,
+                      help='also write the particles that are removed to this star file')
+  args = parser.parse_args()
+  if args.tolerance is not None and args.tolerance <= 0:
+    sys.exit('Error: --tolerance must be greater than 0')
+  if args.output in args.star_files:
+    sys.exit('Error: --output would overwrite one of the star files')
+  merge_particles(args.star_files, args.output, args.report, args.tolerance, args.duplicates_file)
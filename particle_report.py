@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# Particle report: group, defocus, orientation and class summaries from a single read of a RELION particles star file. 19.10.26
+# Replaces running count_group.py, get_defocus_range.py, plot_defocus.py, plot_orientations.py and count_class.py one after another.
+# Read from stdin with - 19.10.26
+# Tables and plots from the compute functions of the other scripts on columns loaded once 19.10.26
+from __future__ import print_function
+import sys
+import json
+import argparse
+import numpy as np
+import matplotlib
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from count_group import group_counts
+from get_defocus_range import micrograph_defocus, defocus_summary
+from count_class import class_counts
+from plot_orientations import orientation_histograms, plot_histograms
+from plot_defocus import class_defocus, plot_classes
+from star_io import read_parquet, open_star, read_star, read_headers
+
+REPORT_LABELS = ['rlnMicrographName', 'rlnGroupNumber', 'rlnGroupName', 'rlnClassNumber',
+                 'rlnDefocusU', 'rlnDefocusV', 'rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi']
+REQUIRED_LABELS = ['rlnMicrographName', 'rlnDefocusU', 'rlnDefocusV', 'rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi']
+INT_LABELS = ['rlnGroupNumber', 'rlnClassNumber', 'rlnOpticsGroup', 'rlnRandomSubset']
+NAME_LABELS = ['rlnMicrographName', 'rlnGroupName', 'rlnImageName']
+
+def read_columns(star_file, labels=REPORT_LABELS, required=REQUIRED_LABELS):
+  # {label: numpy array} for each of labels in the star file, read in one pass. This is the input for
+  # group_counts(), micrograph_defocus(), class_counts(), orientation_histograms(), class_defocus() and
+  # clean_edges.edge_mask() so several analyses can share one read of a large star file. ValueError if
+  # any of the required labels is missing.
+  if star_file.endswith('.parquet'):
+    star_labels = read_headers(star_file)
+  else:
+    f = open_star(star_file)
+    header, star_labels, lines = read_star(f)
+  for label in required:
+    if label not in star_labels:
+      raise ValueError('could not find _{} in {}'.format(label, star_file))
+  columns = [label for label in labels if label in star_labels]
+  if star_file.endswith('.parquet'):
+    table = read_parquet(star_file).read(columns=columns)
+    return {label:table.column(label).to_numpy() for label in columns}
+  index = [star_labels.index(label) for label in columns]
+  values = [[] for label in columns]
+  with f:
+    for line in lines:
+      items = line.split()
+      for v, i in zip(values, index):
+        v.append(items[i])
+  # convert whole columns at once rather than field by field
+  result = {}
+  for label, v in zip(columns, values):
+    if label in INT_LABELS:
+      result[label] = np.array(v).astype(np.int64)
+    elif label in NAME_LABELS:
+      result[label] = np.array(v, dtype=object)
+    else:
+      try:
+        result[label] = np.array(v).astype(np.float64)
+      except ValueError: # other text columns
+        result[label] = np.array(v, dtype=object)
+  return result
+
+def group_report(columns):
+  regrouped = 'rlnGroupNumber' not in columns
+  if regrouped and 'rlnGroupName' not in columns:
+    return [], ['No _rlnGroupNumber or _rlnGroupName - group table skipped']
+  groups, counts, mics = group_counts(columns)
+  total = int(counts.sum())
+  rows = []
+  lines = ['Group   #ptcls    total  Micrograph']
+  running_total = 0
+  for grp, n, mic in zip(groups.tolist(), counts.tolist(), mics):
+    rows.append({'group':grp, 'particles':n, 'remaining':total - running_total, 'micrograph':mic})
+    if not regrouped:
+      lines.append('{:<5d} {:8d} {:8d}  {}'.format(grp, n, total - running_total, mic))
+    else:
+      lines.append('{} {:8d} {:8d}'.format(grp, n, total - running_total))
+    running_total += n
+  return rows, lines
+
+def defocus_report(columns, cutoff):
+  summary = defocus_summary(*micrograph_defocus(columns), cutoff=cutoff)
+  rows = []
+  for row in summary:
+    rows.append({'micrograph':row['micrograph'], 'median':float(row['median']), 'mean':float(row['mean']), 'max':float(row['max']), 'particles':int(row['particles'])})
+    if cutoff is not None:
+      rows[-1]['above_cutoff'] = int(row['above_cutoff'])
+  if cutoff is not None:
+    lines = ['Micrograph                                                         median   mean     max      num > cutoff']
+    lines += [row['micrograph'] + ' {:8.1f} {:8.1f} {:8.1f} {:4d}/{:4d}'.format(row['median'], row['mean'], row['max'], row['above_cutoff'], row['particles']) for row in rows]
+  else:
+    lines = ['Micrograph                                                         median   mean     max      no. ptcls']
+    lines += [row['micrograph'] + ' {:8.1f} {:8.1f} {:8.1f} {:4d}'.format(row['median'], row['mean'], row['max'], row['particles']) for row in rows]
+  return rows, lines
+
+def class_report(columns):
+  if 'rlnClassNumber' not in columns:
+    return {}, ['No _rlnClassNumber - class table skipped']
+  classes, counts = class_counts(columns)
+  total = counts.sum()
+  lines = ['Class  #ptcls  fraction']
+  for cls, n in sorted(zip(classes.tolist(), counts.tolist()), key=lambda x: x[1], reverse=True):
+    lines.append('{:5d} {:7d}  {:8.4f}'.format(cls, n, n / total))
+  return dict(zip(classes.tolist(), counts.tolist())), lines
+
+def defocus_page(pdf, columns, bins):
+  # as plot_defocus.py
+  fig = plt.figure()
+  plot_classes(class_defocus(columns), bins)
+  pdf.savefig(fig)
+  plt.close(fig)
+
+def orientation_page(pdf, columns, bins):
+  # as plot_orientations.py
+  fig = plt.figure()
+  plot_histograms(orientation_histograms(columns, bins)[0])
+  pdf.savefig(fig)
+  plt.close(fig)
+
+def group_page(pdf, group_rows, bins):
+  fig, ax = plt.subplots()
+  ax.hist([row['particles'] for row in group_rows], bins=bins, color='#0072b2')
+  ax.set_xlabel('Particles per group')
+  ax.set_ylabel('Number of groups')
+  pdf.savefig(fig)
+  plt.close(fig)
+
+def make_report(star_file, output, cutoff, bins, orientation_bins):
+  print('Reading particles from {}...'.format(star_file))
+  columns = read_columns(star_file)
+  n_particles = len(columns['rlnMicrographName'])
+  group_rows, group_lines = group_report(columns)
+  defocus_rows, defocus_lines = defocus_report(columns, cutoff)
+  classes, class_lines = class_report(columns)
+  d = (columns['rlnDefocusU'] + columns['rlnDefocusV']) / 2.0
+  pct = [0.1,5,10,25,50,75,90,95,99.9]
+  pc = np.percentile(d, pct)
+  percentile_lines = ['{:4.1f}% particles have defocus < {:.0f} A'.format(p, pc[j]) for j, p in enumerate(pct)]
+  angles = {label:{'min':float(np.min(columns[label])), 'max':float(np.max(columns[label]))} for label in ['rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi']}
+  angle_lines = ['Range of {}: {:0.2f} - {:0.2f}'.format(label, angles[label]['min'], angles[label]['max']) for label in angles]
+
+  with open(output + '.txt', 'w') as f:
+    f.write('{} particles on {} micrographs in {}\n'.format(n_particles, len(defocus_rows), star_file))
+    for lines in [group_lines, defocus_lines, percentile_lines, angle_lines, class_lines]:
+      f.write('\n' + '\n'.join(lines) + '\n')
+  summary = {'star_file':star_file, 'particles':n_particles, 'micrographs':len(defocus_rows),
+             'groups':group_rows, 'defocus':defocus_rows,
+             'defocus_percentiles':dict(zip([str(p) for p in pct], pc.tolist())),
+             'angles':angles, 'classes':{str(cls):n for cls, n in classes.items()}}
+  with open(output + '.json', 'w') as f:
+    json.dump(summary, f, indent=1)
+  with PdfPages(output + '.pdf') as pdf:
+    defocus_page(pdf, columns, bins)
+    orientation_page(pdf, columns, orientation_bins)
+    if len(group_rows) > 0:
+      group_page(pdf, group_rows, bins)
+
+  print('{} particles on {} micrographs in {} groups'.format(n_particles, len(defocus_rows), len(group_rows)))
+  for lines in [percentile_lines, angle_lines, class_lines]:
+    print('\n'.join(lines))
+  print('Writing tables to {0}.txt, summary to {0}.json and plots to {0}.pdf'.format(output))
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description='Group, defocus, orientation and class reports from one read of a particles star file')
+  parser.add_argument('star_file', metavar='run_data.star', type=str,
+                      help='star file from Refine3D or Class3D (or run_data_particles.parquet from star_to_parquet.py, - for stdin)')
+  parser.add_argument('--output', required=False, default='particle_report', metavar='particle_report', type=str,
+                      help='prefix for output .pdf, .txt and .json files')
+  parser.add_argument('--cutoff', required=False, default=None, metavar='15000', type=int,
+                      help='report number of particles with defocus above this cutoff on each micrograph')
+  parser.add_argument('--bins', required=False, default=60, metavar='60', type=int,
+                      help='number of bins in defocus and group histograms')
+  parser.add_argument('--orientation_bins', required=False, default=180, metavar='180', type=int,
+                      help='number of bins in orientation histograms')
+  args = parser.parse_args()
+  matplotlib.use('Agg') # only ever write PDFs
+  try:
+    make_report(star_file=args.star_file, output=args.output, cutoff=args.cutoff, bins=args.bins, orientation_bins=args.orientation_bins)
+  except ValueError as e:
+    sys.exit('Sorry {}'.format(e))
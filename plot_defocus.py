@@ -5,134 +5,285 @@
 # Fixed width bins 08.12.20
 # Better header reading 02.04.21
 # More options 07.11.23, 24.09.24
+# Sampled quick-look mode 19.10.26
+# Per class figures rendered in parallel 19.10.26
+# Only re-plot when inputs or options change (output.manifest.json) 19.10.26
+# Read from stdin with - 19.10.26
+# Checkpoint so a growing micrographs_ctf.star is only read from where the last run stopped 19.10.26
+# class_defocus() and micrograph_ctf() for columns already loaded by another script 19.10.26
 from __future__ import print_function
+import os
 import sys
+import hashlib
 import argparse 
+from multiprocessing import Pool
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
+from manifest import manifest_options, up_to_date, write_manifest
+from star_io import read_parquet, open_star, read_star, read_headers, data_offset
+from sampling import sample_lines, percentile_ci, sample_rows
 
-def read_headers(star_file):
-  data = False
-  with open(star_file) as f:
-    for line in f:
-      if line[0:5] == 'data_' and line.strip()[5:] in ['', 'particles', 'micrographs']:
-        data = True
-        labels = []
-      elif data and line[0] == '_':
-        labels.append(line[line.find('_') + 1:line.find('#') - 1])
-      elif data and len(labels) > 0:
-        return labels
-      else:
-         continue 
-
-def make_plots(star_file, output_file, cutoff, cut_res, bins, select, only_max_res):
-  defocusU_results = []
-  defocusV_results = []
-  astigmatism_results = []
-  ctf_res_results = []
-  classes = {}
+def read_row_groups(pf, columns, label, value):
+  # only read row groups whose min/max statistics for label include value
+  i = pf.schema_arrow.get_field_index(label)
+  groups = []
+  for g in range(pf.num_row_groups):
+    stats = pf.metadata.row_group(g).column(i).statistics
+    if stats is None or not stats.has_min_max or stats.min <= value <= stats.max:
+      groups.append(g)
+  return pf.read_row_groups(groups, columns=columns)
+
+TAIL_CHECK = 4096 # bytes before the saved offset that must be unchanged to trust a checkpoint
+
+def read_checkpoint(checkpoint_file, star_file, start):
+  # Columns and read position saved by the last run, if the header of star_file and the
+  # bytes just before the saved offset are the same as when the checkpoint was written
+  try:
+    checkpoint = np.load(checkpoint_file)
+    offset = int(checkpoint['offset'])
+  except (IOError, ValueError, KeyError):
+    return None
+  if int(checkpoint['start']) != start or os.path.getsize(star_file) < offset:
+    return None
+  with open(star_file, 'rb') as f:
+    header = f.read(start)
+    f.seek(offset - min(TAIL_CHECK, offset - start))
+    tail = f.read(min(TAIL_CHECK, offset - start))
+  if hashlib.sha1(header).hexdigest() != str(checkpoint['header_sha1']) or hashlib.sha1(tail).hexdigest() != str(checkpoint['tail_sha1']):
+    return None
+  return checkpoint
+
+def micrograph_columns(star_file, labels, checkpoint_file):
+  # _rlnDefocusU, _rlnDefocusV and _rlnCtfMaxResolution of every micrograph in a star file that is
+  # still growing, only parsing the lines added since the checkpoint was written
+  index = [labels.index('rlnDefocusU'), labels.index('rlnDefocusV'), labels.index('rlnCtfMaxResolution')]
+  start = data_offset(star_file, labels)
+  checkpoint = read_checkpoint(checkpoint_file, star_file, start)
+  if checkpoint is not None:
+    columns, offset = checkpoint['columns'], int(checkpoint['offset'])
+    print('Read {} micrographs from {}'.format(columns.shape[1], checkpoint_file))
+  else:
+    columns, offset = np.zeros((3, 0)), start
+  with open(star_file, 'rb') as f:
+    header = f.read(start)
+    f.seek(offset)
+    new = f.read()
+    new = new[:new.rfind(b'\n') + 1] # a partly written last line is left for next time
+    # stop after the last data line: RELION writes blank lines after the loop and new rows replace
+    # them, so they must not be part of the bytes checked next time
+    end = len(new.rstrip())
+    new = new[:new.find(b'\n', end) + 1] if end > 0 else b''
+    offset += len(new)
+    f.seek(offset - min(TAIL_CHECK, offset - start))
+    tail = f.read(min(TAIL_CHECK, offset - start))
+  rows = [line.split() for line in new.decode().splitlines() if line.strip() != '']
+  if len(rows) > 0:
+    columns = np.hstack((columns, np.array([[items[i] for i in index] for items in rows], dtype=float).T))
+  print('Read {} new micrographs from {}'.format(len(rows), star_file))
+  with open(checkpoint_file + '.tmp', 'wb') as f:
+    np.savez(f, columns=columns, offset=offset, start=start,
+             header_sha1=hashlib.sha1(header).hexdigest(), tail_sha1=hashlib.sha1(tail).hexdigest())
+  os.replace(checkpoint_file + '.tmp', checkpoint_file)
+  return columns
+
+def class_colors(n):
+  if n == 1:
+    return ['#0072b2']
+  elif n <= 8:
+    return ['#e69f00','#0072b2','#009e73','#cc79a7','#f0e442','#56b4e9','#d55e00','#999999']
+  elif n <= 20:
+    return list(plt.get_cmap('tab20').colors)
+  return [plt.get_cmap('viridis')(i) for i in np.linspace(0.0, 1.0, n)]
+
+def selection_output(output_file, select):
+  # --select_class N with the default output writes defocus_classN.pdf
+  if select is not None and output_file == 'defocus.pdf':
+    return 'defocus_class{}.pdf'.format(select)
+  return output_file
+
+def class_output(output_file, cls):
+  return '{}_class{}.pdf'.format(os.path.splitext(output_file)[0], cls)
+
+def use_agg():
+  # --per_class workers only write PDFs - chosen in the workers so importing this module leaves the backend alone
+  matplotlib.use('Agg')
+
+def plot_class(d, cls, bins, output_file):
+  # one figure per class for --per_class, run in a worker process
+  fig, ax = plt.subplots()
+  ax.hist(d, color='#0072b2', histtype='stepfilled', edgecolor='none', alpha=0.75, bins=bins, range=(np.min(d), np.max(d)))
+  ax.set_xlabel('Defocus ($\mathrm{\AA}$)')
+  ax.set_ylabel('Number of particles')
+  ax.set_title('class {} ({} particles)'.format(cls, d.size), fontsize=10)
+  fig.savefig(output_file, format='pdf')
+  plt.close(fig)
+
+def line_columns(lines, labels, names):
+  # the columns in names of star file data lines as float arrays
+  index = [labels.index(name) for name in names]
+  values = [[] for i in index]
+  for line in lines:
+    items = line.split()
+    for v, i in zip(values, index):
+      v.append(float(items[i]))
+  return {name:np.array(v) for name, v in zip(names, values)}
+
+def class_defocus(columns, select=None):
+  # {class: defocus of its particles} from already loaded columns ({label: numpy array}) with the
+  # largest class first. Without _rlnClassNumber all of the rows are class '1'. ValueError if there
+  # are no particles in class select.
+  d = (columns['rlnDefocusU'] + columns['rlnDefocusV']) / 2.0
+  if 'rlnClassNumber' not in columns:
+    return {'1':d}
+  classes = columns['rlnClassNumber'].astype(int)
+  if select is not None:
+    if not (classes == select).any():
+      raise ValueError('there are no particles in class {}'.format(select))
+    return {select:d[classes == select]}
+  keys, first, counts = np.unique(classes, return_index=True, return_counts=True)
+  return {cls:d[classes == cls] for cls in keys[np.lexsort((first, -counts))].tolist()}
+
+def micrograph_ctf(columns, cutoff=None, cut_res=False):
+  # defocus U and V, mean defocus, astigmatism and CTF maximum resolution of the micrographs with
+  # astigmatism (or with cut_res CTF maximum resolution) below cutoff from already loaded columns
+  u, v, r = columns['rlnDefocusU'], columns['rlnDefocusV'], columns['rlnCtfMaxResolution']
+  a = np.abs(u - v)
+  if cutoff is None:
+    selected = np.ones(len(a), dtype=bool)
+  else:
+    selected = r < cutoff if cut_res else a < cutoff
+  u, v = u[selected], v[selected]
+  return {'rlnDefocusU':u, 'rlnDefocusV':v, 'defocus':(u+v)/2.0, 'astigmatism':a[selected], 'rlnCtfMaxResolution':r[selected]}
+
+def plot_classes(classes, bins, title=None):
+  # histograms of the defocus of each class from class_defocus on the current figure
+  colors = class_colors(len(classes))
+  dmin = 99999.0
+  dmax = 0.0
+  for d in classes.values():
+    if np.min(d) < dmin: dmin = np.min(d)
+    if np.max(d) > dmax: dmax = np.max(d)
+  kwargs = dict(histtype='stepfilled', edgecolor='none', alpha=0.75, bins=bins, range=(dmin, dmax))
+  for i, (cls, d) in enumerate(classes.items()):
+    plt.hist(d, color=colors[i], label='class {}'.format(cls), **kwargs)
+  plt.xlabel('Defocus ($\mathrm{\AA}$)')
+  plt.ylabel('Number of particles')
+  if title is not None:
+    plt.title(title, fontsize=10)
+  if len(classes) > 1:
+    plt.legend(loc='best', fontsize=10, ncol=1 + len(classes) // 20)
+
+def plot_micrographs(ctf, bins, star_file, only_max_res, title=None):
+  # defocus, astigmatism and CTF maximum resolution from micrograph_ctf on the current figure
+  if not only_max_res:
+    plt.subplot2grid((2,2), (0,0))
+    plt.scatter(ctf['rlnDefocusU'], ctf['rlnDefocusV'], s=6)
+    plt.title(star_file)
+    plt.xlabel('Defocus U ($\mathrm{\AA}$)', fontsize=10)
+    plt.ylabel('Defocus V ($\mathrm{\AA}$)', fontsize=10)
+    plt.subplot2grid((2,2), (0,1))
+    plt.hist(ctf['defocus'], bins=bins)
+    plt.xlabel('Defocus ($\mathrm{\AA}$)', fontsize=10)
+    plt.ylabel('Number of micrographs', fontsize=10)
+    plt.subplot2grid((2,2), (1,0))
+    plt.hist(ctf['astigmatism'], bins=bins)
+    plt.xlabel('Astigmatism ($\mathrm{\AA}$)', fontsize=10)
+    plt.ylabel('Number of micrographs', fontsize=10)
+    plt.subplot2grid((2,2), (1,1))
+  plt.hist(ctf['rlnCtfMaxResolution'], bins=bins)
+  plt.xlabel('CTF Maximum resolution ($\mathrm{\AA}$)', fontsize=10)
+  plt.ylabel('Number of micrographs', fontsize=10)
+  if title is not None:
+    plt.suptitle(title, fontsize=10)
+  plt.tight_layout()
+
+def make_plots(star_file, output_file, cutoff, cut_res, bins, select, only_max_res, sample=None, fraction=None, seed=0, per_class=False, nproc=None, checkpoint=None):
   if cutoff is None:
     cutoff = 999999.99
-  labels = read_headers(star_file)
-  u = v = n = None
-  try:
-    n, u, v = labels.index('rlnClassNumber'), labels.index('rlnDefocusU'), labels.index('rlnDefocusV')
-    data_particles = True
-  except ValueError:
-    u, v, r = labels.index('rlnDefocusU'), labels.index('rlnDefocusV'), labels.index('rlnCtfMaxResolution')
-    data_particles = False
-
-  with open(star_file) as f:
-    data = False
-    for line in f:
-      if data and line.strip() != '':
-        items = line.split()
-        if u is not None and v is not None:
-          if n is None:
-            a = abs(float(items[u]) - float(items[v]))
-            res = float(items[r])
-            if (a < cutoff and not cut_res) or (res < cutoff and cut_res):
-              defocusU_results.append(float(items[u]))
-              defocusV_results.append(float(items[v]))
-              ctf_res_results.append(res)
-              astigmatism_results.append(a)
-          elif n is not None:
-            try:
-              classes[int(items[n])]['defocusU_results'].append(float(items[u]))
-              classes[int(items[n])]['defocusV_results'].append(float(items[v]))
-            except KeyError:
-              classes[int(items[n])] = {'defocusU_results':[float(items[u])]}
-              classes[int(items[n])].update({'defocusV_results':[float(items[v])]})
-          else:
-            sys.exit('Sorry could not find _rlnDefocusU or _rlnDefocusV in {}'.format(star_file))
-      elif line.startswith('_' + labels[-1]):
-        data = True
-      else:
-        continue
-
-  assert len(defocusU_results) == len(defocusV_results)
+  if star_file.endswith('.parquet'):
+    labels = read_headers(star_file, ['', 'particles', 'micrographs'])
+  else:
+    f = open_star(star_file)
+    header, labels, lines = read_star(f, ['', 'particles', 'micrographs'])
+  data_particles = 'rlnClassNumber' in labels
+  names = ['rlnClassNumber', 'rlnDefocusU', 'rlnDefocusV'] if data_particles else ['rlnDefocusU', 'rlnDefocusV', 'rlnCtfMaxResolution']
+  for name in names:
+    if name not in labels:
+      sys.exit('Sorry could not find _{} in {}'.format(name, star_file))
+  if per_class and not data_particles:
+    sys.exit('Sorry --per_class needs _rlnClassNumber in {}'.format(star_file))
+  if checkpoint is not None and data_particles:
+    sys.exit('Sorry --checkpoint is only for micrograph star files from CtfFind')
+  pool = None
+  outputs = []
+  selection = ''
+
+  sampled = sample is not None or fraction is not None
+  if star_file.endswith('.parquet'):
+    pf = read_parquet(star_file)
+    table = pf.read(columns=names) if not data_particles or select is None else read_row_groups(pf, names, 'rlnClassNumber', select)
+    columns = {name:table.column(name).to_numpy() for name in names}
+    if data_particles and select is not None:
+      # the row groups read can have other classes too so the sample is only taken from the selected class
+      rows = columns['rlnClassNumber'].astype(int) == select
+      columns = {name:c[rows] for name, c in columns.items()}
+      selection = ' in class {}'.format(select)
+    if sampled:
+      n_rows = len(columns[names[0]])
+      rows = sample_rows(n_rows, sample, fraction, seed)
+      columns = {name:c[rows] for name, c in columns.items()}
+      n_sampled = len(rows)
+      print('Sampled {} of {} rows{} from {}'.format(n_sampled, n_rows, selection, star_file))
+      if n_sampled == 0:
+        sys.exit('Sorry the sample of {} is empty'.format(star_file))
+  elif checkpoint is not None:
+    f.close()
+    columns = dict(zip(names, micrograph_columns(star_file, labels, checkpoint)))
+  else:
+    with f:
+      if sampled:
+        lines, n_rows = sample_lines(lines, sample, fraction, seed)
+        n_sampled = len(lines)
+        print('Sampled {} of {} rows from {}'.format(n_sampled, n_rows, star_file))
+        if n_sampled == 0:
+          sys.exit('Sorry the sample of {} is empty'.format(star_file))
+      columns = line_columns(lines, labels, names)
+
+  if data_particles:
+    classes = class_defocus(columns, select)
+    if select is not None and selection == '':
+      # a sample of a star file is taken from all rows before the class is selected
+      selection = ', {} in class {}'.format(classes[select].size, select)
+  else:
+    ctf = micrograph_ctf(columns, cutoff, cut_res)
   if data_particles or any(n in star_file for n in ['data', 'particles', 'shiny']): 
-    colors = ['#e69f00','#0072b2','#009e73','#cc79a7','#f0e442','#56b4e9','#d55e00','#999999']
-    if n is None:
-      classes = {'1':{'defocusU_results':defocusU_results, 'defocusV_results':defocusV_results}}
-    if select is not None:
-      classes = {select:classes[select]}
-      if output_file == 'defocus.pdf':
-        output_file = 'defocus_class{}.pdf'.format(select)
+    if not data_particles:
+      classes = class_defocus(ctf)
+    output_file = selection_output(output_file, select)
     if len(classes) == 1:
-      colors = ['#0072b2']
-    dmin = 99999.0
-    dmax = 0.0 
-    data = []
-    labels = []
-    for cls in sorted(classes, key=lambda c: len(classes[c]['defocusU_results']), reverse=True):
-      u = np.array(classes[cls]['defocusU_results'])
-      v = np.array(classes[cls]['defocusV_results'])
-      d = (u+v)/2.0
-      if len(classes) == 1:
-        pct = [0.1,5,10,25,50,75,90,95,99.9]
-        pc = np.percentile(d,pct)
-        for j, p in enumerate(pct):
+      d = list(classes.values())[0]
+      pct = [0.1,5,10,25,50,75,90,95,99.9]
+      pc = np.percentile(d,pct)
+      if sampled:
+        lo, hi = percentile_ci(d, pct)
+      for j, p in enumerate(pct):
+        if sampled:
+          print('{:4.1f}% particles have defocus < {:.0f} A (95% CI {:.0f} - {:.0f} A)'.format(p, pc[j], lo[j], hi[j]))
+        else:
           print('{:4.1f}% particles have defocus < {:.0f} A'.format(p, pc[j]))
-      if np.min(d) < dmin: dmin = np.min(d)
-      if np.max(d) > dmax: dmax = np.max(d)
-      data.append(d)
-      labels.append('class {}'.format(cls))
-    kwargs = dict(histtype='stepfilled', edgecolor='none', alpha=0.75, bins=bins, range=(dmin, dmax))
-    for i, d in enumerate(data):
-      if i < 9:
-        plt.hist(d, color=colors[i], label=labels[i], **kwargs)
-      else: 
-        plt.hist(d, **kwargs)
-    plt.xlabel('Defocus ($\mathrm{\AA}$)')
-    plt.ylabel('Number of particles')
-    if len(classes) > 1:
-      plt.legend(loc='best', fontsize=10)
+    if per_class:
+      print('Class  #ptcls       5%   median      95%')
+      for cls, d in classes.items():
+        pc = np.percentile(d, [5, 50, 95])
+        print('{:5d} {:7d} {:8.0f} {:8.0f} {:8.0f}'.format(cls, d.size, pc[0], pc[1], pc[2]))
+      print('Writing defocus results for {} classes to {}'.format(len(classes), class_output(output_file, '*')))
+      pool = Pool(nproc, initializer=use_agg)
+      outputs = [class_output(output_file, cls) for cls in classes]
+      jobs = pool.starmap_async(plot_class, [(d, cls, bins, class_output(output_file, cls)) for cls, d in classes.items()])
+    plot_classes(classes, bins, 'Sampled {} of {} particles{}'.format(n_sampled, n_rows, selection) if sampled else None)
   else:
-    u = np.array(defocusU_results)
-    v = np.array(defocusV_results)
-    d = (u+v)/2.0
-    a = np.array(astigmatism_results)
-    r = np.array(ctf_res_results)
-    if not only_max_res:
-      plt.subplot2grid((2,2), (0,0))
-      plt.scatter(u,v, s=6)
-      plt.title(star_file)
-      plt.xlabel('Defocus U ($\mathrm{\AA}$)', fontsize=10)
-      plt.ylabel('Defocus V ($\mathrm{\AA}$)', fontsize=10)
-      plt.subplot2grid((2,2), (0,1))
-      plt.hist(d, bins=bins)
-      plt.xlabel('Defocus ($\mathrm{\AA}$)', fontsize=10)
-      plt.ylabel('Number of micrographs', fontsize=10)
-      plt.subplot2grid((2,2), (1,0))
-      plt.hist(a, bins=bins)
-      plt.xlabel('Astigmatism ($\mathrm{\AA}$)', fontsize=10)
-      plt.ylabel('Number of micrographs', fontsize=10)
-      plt.subplot2grid((2,2), (1,1))
-    plt.hist(r, bins=bins)
-    plt.xlabel('CTF Maximum resolution ($\mathrm{\AA}$)', fontsize=10)
-    plt.ylabel('Number of micrographs', fontsize=10)
-    plt.tight_layout()
+    plot_micrographs(ctf, bins, star_file, only_max_res, 'Sampled {} of {} micrographs'.format(n_sampled, n_rows) if sampled else None)
   if cutoff != 999999.99 and not cut_res:
     print('Writing defocus results with astigmatism lower than than {:0.2f} to {}'.format(cutoff, output_file))
   elif cutoff != 999999.99 and cut_res:
@@ -141,11 +292,16 @@ def make_plots(star_file, output_file, cutoff, cut_res, bins, select, only_max_r
     print('Writing defocus results to {}'.format(output_file))
   plt.savefig(output_file, format='pdf')
   plt.close()
+  if pool is not None:
+    jobs.get()
+    pool.close()
+    pool.join()
+  return [output_file] + outputs
 
 if __name__=='__main__':
   parser = argparse.ArgumentParser(description='Plot per micrograph or per particle defocus')
   parser.add_argument('star_file', metavar='[micrographs_ctf.star, particles_ctf_refine.star]', type=str,
-                      help='star file from CtfFind or with refined CTF parameters')
+                      help='star file from CtfFind or with refined CTF parameters (- for stdin)')
   parser.add_argument('--output', required=False, default='defocus.pdf', metavar='defocus.pdf', type=str,
                       help='output file_name')
   parser.add_argument('--cutoff', required=False, default=999999.99, metavar='999.9', type=float,
@@ -156,6 +312,43 @@ if __name__=='__main__':
                       help='just plot this class')
   parser.add_argument('--only_max_res', required=False, default=False, action='store_true',
                       help='only plot CTF maximum resolutiob')
+  parser.add_argument('--per_class', required=False, default=False, action='store_true',
+                      help='also write a plot for each class (defocus_classN.pdf) from a single read of the star file')
+  parser.add_argument('--nproc', required=False, default=None, metavar='8', type=int,
+                      help='number of processes for rendering --per_class plots (default: all CPUs)')
+  sampling = parser.add_mutually_exclusive_group(required=False)
+  sampling.add_argument('--sample', required=False, default=None, metavar='100000', type=int,
+                      help='quick look: plot a random sample of this many rows')
+  sampling.add_argument('--fraction', required=False, default=None, metavar='0.01', type=float,
+                      help='quick look: plot this fraction of rows')
+  parser.add_argument('--seed', required=False, default=0, metavar='0', type=int,
+                      help='random seed for --sample or --fraction')
+  parser.add_argument('--checkpoint', required=False, default=None, metavar='defocus.npz', type=str,
+                      help='keep the values read so far in this file and only read micrographs added to the star file since the last run')
+  parser.add_argument('--force', required=False, default=False, action='store_true',
+                      help='plot even if the output is up to date with its inputs')
+  parser.add_argument('--checksum', required=False, default=False, action='store_true',
+                      help='also record input checksums so only a change of content makes the plot out of date')
   args = parser.parse_args()
+  matplotlib.use('Agg') # only ever write PDFs
+  if args.sample is not None and args.sample < 1:
+    sys.exit('Error: --sample must be at least 1')
+  if args.fraction is not None and not 0.0 < args.fraction <= 1.0:
+    sys.exit('Error: --fraction must be between 0 and 1')
+  if args.per_class and args.select_class is not None:
+    sys.exit('Error: --per_class and --select_class cannot be used together')
+  if args.checkpoint is not None and (args.sample is not None or args.fraction is not None or args.star_file == '-' or args.star_file.endswith('.parquet')):
+    sys.exit('Error: --checkpoint needs all rows of a star file on disk')
+  options = manifest_options(args, ['star_file', 'nproc', 'checkpoint'])
+  output_file = selection_output(args.output, args.select_class)
+  if args.star_file != '-' and not args.force and up_to_date(output_file, [args.star_file], options):
+    print('{} is up to date with {} (use --force to plot anyway)'.format(output_file, args.star_file))
+    sys.exit()
   cut_res = True if args.cutoff <= 25. else False
-  make_plots(star_file=args.star_file, output_file=args.output, bins=args.bins, cutoff=args.cutoff, cut_res=cut_res, select=args.select_class, only_max_res=args.only_max_res)
+  try:
+    outputs = make_plots(star_file=args.star_file, output_file=output_file, bins=args.bins, cutoff=args.cutoff, cut_res=cut_res, select=args.select_class, only_max_res=args.only_max_res,
+               sample=args.sample, fraction=args.fraction, seed=args.seed, per_class=args.per_class, nproc=args.nproc, checkpoint=args.checkpoint)
+  except ValueError as e:
+    sys.exit('Sorry {}'.format(e))
+  if args.star_file != '-': # nothing to check a plot from stdin against
+    write_manifest(output_file, [args.star_file], options, args.checksum, outputs)
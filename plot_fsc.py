@@ -2,34 +2,53 @@
 # Plot FSC curves from RELION postprocess.star files. Author Huw Jenkins 03.07.20
 # Better header reading 02.04.21
 # Model:map FSC 250523
+# Only re-plot when inputs or options change (output.manifest.json) 191026
+# FSC calculated from the half maps and mask in postprocess.star with --half_maps 191026
+# fsc_curves(), read_model_fsc() and plot_fsc() for use from other scripts 191026
 from __future__ import print_function
+import os
 import sys
 import argparse
 import json
+import struct
 import numpy as np
 import matplotlib.pyplot as plt
+from manifest import manifest_options, up_to_date, write_manifest
+from star_io import read_parquet, read_headers
 
-def read_headers(star_file):
+def read_general(star_file):
+  # {label: value} from the data_general block (or _general.parquet from star_to_parquet.py)
+  if star_file.endswith('.parquet'):
+    general = star_file.replace('_fsc.parquet', '_general.parquet')
+    if not os.path.isfile(general):
+      return {}
+    return read_parquet(general).read().to_pylist()[0]
+  general = {}
   data = False
   with open(star_file) as f:
     for line in f:
-      if line[0:5] == 'data_' and line.strip()[5:] in ['', 'fsc']:
-        data = True
-        labels = []
+      if line[0:5] == 'data_':
+        if data:
+          break
+        data = line.strip() == 'data_general'
       elif data and line[0] == '_':
-        labels.append(line[line.find('_') + 1:line.find('#') - 1])
-      elif data and len(labels) > 0:
-        return labels
-      else:
-         continue 
+        items = line.split()
+        general[items[0][1:]] = items[1] if len(items) > 1 else ''
+  return general
 
-def make_plot(star_files, json_file, output_file, show_legend, legend, colors):
-  curves = []
-  invresols = []
-  fscs = []
-  for star_file in star_files: 
-    labels = read_headers(star_file)
-    r, f = labels.index('rlnResolution'), labels.index('rlnFourierShellCorrelationCorrected')
+def read_fsc(star_file):
+  # curve name, 1/resolution and FSC of the rlnFourierShellCorrelationCorrected table
+  labels = read_headers(star_file, ['', 'fsc'])
+  r, f = labels.index('rlnResolution'), labels.index('rlnFourierShellCorrelationCorrected')
+  curve = star_file
+  if star_file.endswith('.parquet'):
+    table = read_parquet(star_file).read(columns=[labels[r], labels[f]])
+    invres, fsc = table.column(0).to_pylist(), table.column(1).to_pylist()
+    general = star_file.replace('_fsc.parquet', '_general.parquet')
+    if os.path.isfile(general):
+      half1 = read_parquet(general).read(columns=['rlnUnfilteredMapHalf1']).column(0)[0].as_py()
+      curve = '_'.join(half1.split('/')[0:2])
+  else:
     with open(star_file) as sf:
       data = False
       invres = []
@@ -43,51 +62,199 @@ def make_plot(star_files, json_file, output_file, show_legend, legend, colors):
           elif 'data_guinier' in line: 
             break
         elif line[0] == '_' and line[line.find('_') + 1:line.find(' ')] == 'rlnUnfilteredMapHalf1':
-          curves.append('_'.join(line.split()[1].split('/')[0:2]))
+          curve = '_'.join(line.split()[1].split('/')[0:2])
         elif line.startswith('_' + labels[-1]):
           data = True
         else:
           continue
+  return curve, invres, fsc
+
+MRC_MODES = {0:'i1', 1:'i2', 2:'f4', 6:'u2', 12:'f2'}
+
+def read_mrc(mrc_file):
+  # Memory-mapped map (z, y, x) and pixel size from the MRC header, so the map is only read when it is used
+  with open(mrc_file, 'rb') as f:
+    header = f.read(1024)
+  if len(header) < 1024:
+    raise ValueError('{} is not an MRC file'.format(mrc_file))
+  byteorder = '>' if header[212:214] == b'\x11\x11' else '<'
+  nx, ny, nz, mode = struct.unpack(byteorder + '4i', header[0:16])
+  mx = struct.unpack(byteorder + 'i', header[28:32])[0]
+  xlen = struct.unpack(byteorder + 'f', header[40:44])[0]
+  nsymbt = struct.unpack(byteorder + 'i', header[92:96])[0]
+  if mode not in MRC_MODES:
+    raise ValueError('MRC mode {} of {} is not supported'.format(mode, mrc_file))
+  data = np.memmap(mrc_file, dtype=byteorder + MRC_MODES[mode], mode='r', offset=1024 + nsymbt, shape=(nz, ny, nx))
+  return data, xlen / mx if mx > 0 else 0.0
+
+SHELLS = {} # shell index for each map shape, reused for every pair of maps of that size
+
+def shell_index(shape):
+  # Fourier shell of each voxel of rfftn() of a cubic map. Shells beyond Nyquist all go into one extra shell that is dropped.
+  if shape not in SHELLS:
+    n = shape[0]
+    k = np.fft.fftfreq(n, 1.0 / n).astype(np.float32)
+    kx = np.arange(n // 2 + 1, dtype=np.float32)
+    r = np.sqrt(k[:, None, None]**2 + k[None, :, None]**2 + kx[None, None, :]**2)
+    SHELLS[shape] = np.minimum(np.rint(r), n // 2 + 1).astype(np.intp)
+  return SHELLS[shape]
+
+def shell_sums(values, shells, n_shells):
+  # Sum of values over each shell of the full transform. rfftn() only has kx >= 0 so the other half
+  # is counted by doubling, except for the kx = 0 (and Nyquist) planes which are there in full.
+  planes = [0, shells.shape[0] // 2] if shells.shape[0] % 2 == 0 else [0]
+  sums = 2 * np.bincount(shells.ravel(), weights=values.ravel(), minlength=n_shells + 1)
+  sums -= np.bincount(shells[:, :, planes].ravel(), weights=values[:, :, planes].ravel(), minlength=n_shells + 1)
+  return sums[:n_shells]
+
+def fourier_transform(data):
+  # multi-threaded real-input FFT from scipy if it is available
+  try:
+    from scipy import fft
+    return fft.rfftn(data, workers=-1)
+  except ImportError:
+    return np.fft.rfftn(data)
+
+def fourier_shell_correlation(ft1, ft2, shells, n_shells):
+  cross = shell_sums(ft1.real * ft2.real + ft1.imag * ft2.imag, shells, n_shells)
+  power1 = shell_sums(ft1.real**2 + ft1.imag**2, shells, n_shells)
+  power2 = shell_sums(ft2.real**2 + ft2.imag**2, shells, n_shells)
+  with np.errstate(invalid='ignore', divide='ignore'):
+    fsc = cross / np.sqrt(power1 * power2)
+  return np.nan_to_num(fsc)
+
+def half_map_fsc(half1_file, half2_file, mask_file=None, angpix=None):
+  # 1/resolution, unmasked FSC and masked FSC (None without a mask) of a pair of half maps.
+  # Unlike relion_postprocess there is no phase randomisation so the masked FSC is not corrected for the mask.
+  half1, pixel_size = read_mrc(half1_file)
+  half2 = read_mrc(half2_file)[0]
+  if half1.shape != half2.shape:
+    raise ValueError('{} and {} have different sizes'.format(half1_file, half2_file))
+  if len(set(half1.shape)) != 1:
+    raise ValueError('{} is not a cubic map'.format(half1_file))
+  if angpix is None:
+    angpix = pixel_size
+  if angpix <= 0:
+    raise ValueError('no pixel size in {} - give --angpix'.format(half1_file))
+  box = half1.shape[0]
+  n_shells = box // 2 + 1
+  shells = shell_index(half1.shape)
+  invres = np.arange(n_shells) / (box * angpix)
+  half1 = np.asarray(half1, dtype=np.float32)
+  half2 = np.asarray(half2, dtype=np.float32)
+  unmasked = fourier_shell_correlation(fourier_transform(half1), fourier_transform(half2), shells, n_shells)
+  masked = None
+  if mask_file is not None:
+    mask = read_mrc(mask_file)[0]
+    if mask.shape != half1.shape:
+      raise ValueError('mask {} is not the same size as the half maps'.format(mask_file))
+    mask = np.asarray(mask, dtype=np.float32)
+    masked = fourier_shell_correlation(fourier_transform(half1 * mask), fourier_transform(half2 * mask), shells, n_shells)
+  return invres, unmasked, masked
 
+def project_path(path, star_file):
+  # file names in postprocess.star are relative to the RELION project directory above PostProcess/jobNNN
+  if os.path.isabs(path) or os.path.isfile(path):
+    return path
+  project = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(star_file))))
+  return os.path.join(project, path)
+
+def half_map_files(star_file, mask_file=None):
+  # half maps and mask (--mask or _rlnMaskName) used for star_file
+  general = read_general(star_file)
+  files = []
+  for label in ['rlnUnfilteredMapHalf1', 'rlnUnfilteredMapHalf2']:
+    if label not in general:
+      raise ValueError('could not find _{} in {}'.format(label, star_file))
+    files.append(project_path(general[label], star_file))
+  if mask_file is None and general.get('rlnMaskName', '') not in ['', 'None']:
+    mask_file = project_path(general['rlnMaskName'], star_file)
+  files.append(mask_file)
+  for f in files:
+    if f is not None and not os.path.isfile(f):
+      raise ValueError('could not find {} from {}'.format(f, star_file))
+  return files
+
+def fsc_resolution(invres, fsc, threshold=0.143):
+  # resolution of the last shell before the FSC first falls below threshold
+  below = np.flatnonzero(fsc[1:] < threshold)
+  i = below[0] if len(below) > 0 else len(fsc) - 1
+  return 1.0 / invres[i] if i > 0 else float('inf')
+
+def fsc_curves(star_files, half_maps=False, mask_file=None, angpix=None):
+  # Curve names, 1/resolution of the shells, FSC of each curve (curves x shells) and for half maps with a mask the
+  # unmasked FSC of each curve (otherwise None). ValueError unless all of the curves have the same shells.
+  curves = []
+  invresols = []
+  fscs = []
+  unmasked = []
+  for star_file in star_files: 
+    if half_maps:
+      half1_file, half2_file, mask = half_map_files(star_file, mask_file)
+      print('Calculating FSC of {} and {}{}...'.format(half1_file, half2_file, ' with mask {}'.format(mask) if mask is not None else ''))
+      invres, fsc_unmasked, fsc = half_map_fsc(half1_file, half2_file, mask, angpix)
+      curves.append('_'.join(read_general(star_file)['rlnUnfilteredMapHalf1'].split('/')[0:2]))
+      if fsc is None: # only the unmasked FSC to plot
+        fsc, fsc_unmasked = fsc_unmasked, None
+        curves[-1] += ' (unmasked)'
+      unmasked.append(fsc_unmasked)
+      invres = invres.tolist()
+    else:
+      curve, invres, fsc = read_fsc(star_file)
+      curves.append(curve)
+      unmasked.append(None)
     invresols.append(invres)
     fscs.append(fsc)
     invresols = list({tuple(r) for r in invresols})
   i = np.vstack(invresols)
   f = np.array(fscs)
-
-  if json_file is not None:
-    with open(json_file, 'r') as jf:
-      r = json.load(jf)
-    inv_res = []
-    fsc = []
-    for bin in r:
-      inv_res.append(1/bin['d_min'])
-      fsc.append(bin['fsc_model'])
   if i.shape[0] != 1:
-    sys.exit('Error: plotting FSCs with different resolution bins is not supported!')
+    raise ValueError('plotting FSCs with different resolution bins is not supported!')
   if i.shape[1] != f.shape[1]:
-    sys.exit('Error: Mis-match between no. of resolution shells and FSC values!')
+    raise ValueError('mis-match between no. of resolution shells and FSC values!')
+  return curves, i[0], f, unmasked
+
+def read_model_fsc(json_file):
+  # 1/resolution and model:map FSC from the JSON file written by Servalcat
+  with open(json_file, 'r') as jf:
+    r = json.load(jf)
+  return np.array([1/bin['d_min'] for bin in r]), np.array([bin['fsc_model'] for bin in r])
+
+def plot_fsc(curves, invres, fscs, unmasked, model=None, show_legend=True, colors=None):
+  # figure of the curves from fsc_curves() and the model:map FSC from read_model_fsc()
   if colors is None:
     colors = ['#0072b2','#e69f00','#009e73','#cc79a7','#f0e442','#56b4e9','#d55e00','#999999']
-  if legend is not None:
-    curves = legend
   fig, ax = plt.subplots()
   for c in range(len(curves)):
     if c < 9:
-      ax.plot(i[0], f[c], '-', linewidth=2, color=colors[c], label=curves[c])
+      line = ax.plot(invres, fscs[c], '-', linewidth=2, color=colors[c], label=curves[c])
     else:
-      ax.plot(i[0], f[c], '-', linewidth=2, label=curves[c])
+      line = ax.plot(invres, fscs[c], '-', linewidth=2, label=curves[c])
+    if unmasked[c] is not None: # half map FSC without the mask
+      ax.plot(invres, unmasked[c], '--', linewidth=1, color=line[0].get_color(), label=curves[c] + ' (unmasked)')
   ax.axhline(y=0.143, ls='--', color='#000000')
-  if json_file is not None:
-    i = np.array(inv_res)
-    f = np.array(fsc)
-    ax.plot(i, f, '-', linewidth=2, color='#999999', label='model:map')
+  if model is not None:
+    ax.plot(model[0], model[1], '-', linewidth=2, color='#999999', label='model:map')
     ax.axhline(y=0.5, ls='--', color='#000000')
   ax.set_xlabel('Resolution (1/$\mathrm{\AA}$)')
   ax.set_ylabel('FSC')
   if show_legend:
     ax.legend(loc='center left', fontsize=10)
   ax.tick_params(axis='x', direction='out')
+  return fig
+
+def make_plot(star_files, json_file, output_file, show_legend, legend, colors, half_maps=False, mask_file=None, angpix=None):
+  curves, invres, fscs, unmasked = fsc_curves(star_files, half_maps, mask_file, angpix)
+  if half_maps:
+    for curve, fsc, fsc_unmasked in zip(curves, fscs, unmasked):
+      name = '{}: '.format(curve) if len(curves) > 1 else ''
+      if fsc_unmasked is None:
+        print('{}Unmasked FSC = 0.143 at {:.2f} A'.format(name, fsc_resolution(invres, fsc)))
+      else:
+        print('{}Unmasked FSC = 0.143 at {:.2f} A'.format(name, fsc_resolution(invres, fsc_unmasked)))
+        print('{}Masked FSC = 0.143 at {:.2f} A'.format(name, fsc_resolution(invres, fsc)))
+  model = read_model_fsc(json_file) if json_file is not None else None
+  fig = plot_fsc(legend if legend is not None else curves, invres, fscs, unmasked, model, show_legend, colors)
   print('Writing results to {}'.format(output_file))
   fig.savefig(output_file, format='pdf')
 
@@ -105,8 +272,18 @@ if __name__ == '__main__':
                       help='comma separated list for curves in legend')
   parser.add_argument('--json', required=False, default=None, metavar='refined_fsc.json', type=str,
                       help='JSON file from Servalcat')
+  parser.add_argument('--half_maps', required=False, default=False, action='store_true',
+                      help='calculate unmasked and masked FSCs from the half maps and mask in the postprocess.star files')
+  parser.add_argument('--mask', required=False, default=None, metavar='MaskCreate/job021/mask.mrc', type=str,
+                      help='with --half_maps use this mask instead of the one in the postprocess.star files')
+  parser.add_argument('--angpix', required=False, default=None, metavar='1.0', type=float,
+                      help='with --half_maps use this pixel size instead of the one in the half map header')
+  parser.add_argument('--force', required=False, default=False, action='store_true',
+                      help='plot even if the output is up to date with its inputs')
+  parser.add_argument('--checksum', required=False, default=False, action='store_true',
+                      help='also record input checksums so only a change of content makes the plot out of date')
   args = parser.parse_args()
-  if len([f for f in args.star_files if 'postprocess.star' in f]) != len(args.star_files):
+  if len([f for f in args.star_files if 'postprocess.star' in f or 'postprocess_fsc.parquet' in f]) != len(args.star_files):
     sys.exit('Error: You need to give a list of postprocess.star files')
   if len(args.star_files) > 1 and args.json is not None:
     sys.exit('Error: You can only plot 1 1/2 map FSC and 1 model:map FSC')
@@ -116,4 +293,25 @@ if __name__ == '__main__':
       sys.exit('Error: Mismatch between number of labels and number of star files')
   if colors is not None and len(colors) != len(args.star_files):
       sys.exit('Error: Mismatch between number of colours and number of star files')
-  make_plot(star_files=args.star_files, json_file=args.json, output_file=args.output, show_legend=not(args.no_legend), legend=legend, colors=colors)
+  inputs = list(args.star_files)
+  inputs += [f.replace('_fsc.parquet', '_general.parquet') for f in args.star_files if os.path.isfile(f.replace('_fsc.parquet', '_general.parquet'))]
+  if args.half_maps:
+    for star_file in args.star_files:
+      try:
+        inputs += [f for f in half_map_files(star_file, args.mask) if f is not None and f not in inputs]
+      except ValueError as e:
+        sys.exit('Sorry {}'.format(e))
+  elif args.mask is not None or args.angpix is not None:
+    sys.exit('Error: --mask and --angpix are only used with --half_maps')
+  if args.json is not None:
+    inputs.append(args.json)
+  options = manifest_options(args, ['star_files', 'json'])
+  if not args.force and up_to_date(args.output, inputs, options):
+    print('{} is up to date (use --force to plot anyway)'.format(args.output))
+    sys.exit()
+  try:
+    make_plot(star_files=args.star_files, json_file=args.json, output_file=args.output, show_legend=not(args.no_legend), legend=legend, colors=colors,
+              half_maps=args.half_maps, mask_file=args.mask, angpix=args.angpix)
+  except ValueError as e:
+    sys.exit('Sorry {}'.format(e))
+  write_manifest(args.output, inputs, options, args.checksum)
@@ -1,19 +1,40 @@
 #! /usr/bin/env python
 # Plot class distributions and log-likelihood from RELION model.star files. Author: Huw Jenkins 19.05.20
+# Only re-plot when inputs or options change (output.manifest.json) 19.10.26
+# read_iterations() and plot_iterations() for use from other scripts 19.10.26
 from __future__ import print_function
 import os
+import re
 import sys
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
+from manifest import manifest_options, up_to_date, write_manifest
+from star_io import read_parquet
 
-def make_plot(star_files, output_file):
-  n_itns = len(star_files)
+def iteration(star_file):
+  # run_it025_model.star or run_it025_model_model_classes.parquet -> 25
+  m = re.search(r'_it(\d+)_', os.path.basename(star_file))
+  if m is None:
+    raise ValueError('could not find the iteration number in {}'.format(star_file))
+  return int(m.group(1))
+
+def read_iterations(star_files):
+  # iteration numbers, log-likelihoods and class distributions (classes x iterations) in iteration order
   itn = []
   ll = []
   dist = []
-  for star_file in sorted(star_files, key=lambda x: int(x[x.find('_it') + 3:x.find('_model.star')])): 
-    itn.append(int(star_file[star_file.find('_it') + 3:star_file.find('_model.star')]))
+  for star_file in sorted(star_files, key=iteration):
+    itn.append(iteration(star_file))
+    if star_file.endswith('.parquet'):
+      # run_itNNN_model_model_classes.parquet and run_itNNN_model_model_general.parquet
+      general = read_parquet(star_file.replace('_model_classes.parquet', '_model_general.parquet')).read(columns=['rlnLogLikelihood', 'rlnNrClasses'])
+      ll.append(general.column(0)[0].as_py())
+      n_classes = general.column(1)[0].as_py()
+      c = read_parquet(star_file).read(columns=['rlnClassDistribution']).column(0).to_pylist()
+      assert len(c) == n_classes
+      dist.append(c)
+      continue
     data = False
     with open(star_file) as f:
       data = False
@@ -34,13 +55,13 @@ def make_plot(star_files, output_file):
           assert len(c) == n_classes
           dist.append(c)
           break
+  return np.array(itn), np.array(ll), np.array(dist).T
 
-  i = np.array(itn)
-  l = np.array(ll)
-  d = np.array(dist).T
+def plot_iterations(i, l, d):
+  # figure of class distributions and log-likelihood against iteration from read_iterations()
   colors = ['#e69f00','#0072b2','#009e73','#cc79a7','#f0e442','#56b4e9','#d55e00','#999999']
   fig, ax = plt.subplots()
-  for c in range(n_classes):
+  for c in range(d.shape[0]):
     if c < 8:
       ax.plot(i, d[c], '-', linewidth=2, color=colors[c], label='Class {}'.format(c+1))
     else:
@@ -50,19 +71,27 @@ def make_plot(star_files, output_file):
   ax.legend(loc='upper left', fontsize=10)
   ax.tick_params(axis='x', direction='out')
   ax2 = ax.twinx()
-  ax2.plot(itn, l, '-', linewidth=2, color='#000000', label='LogLikelihood')
+  ax2.plot(i, l, '-', linewidth=2, color='#000000', label='LogLikelihood')
   ax2.set_ylim(0)
   ax2.set_ylabel('LogLikelihood')
   ax2.legend(loc='upper center', fontsize=10)
+  return fig
+
+def make_plot(star_files, output_file):
+  fig = plot_iterations(*read_iterations(star_files))
   print('Writing results to {}'.format(output_file))
   fig.savefig(output_file, format='pdf')
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser(description='Plot progress of classification from run_itNNN_model.star files')
   parser.add_argument('star_files', metavar='run_it0*_model.star', type=str, nargs='+',
-                      help='list of star files (use * or ?? to match multiple files')
+                      help='list of star files (use * or ?? to match multiple files) or run_it0*_model_model_classes.parquet from star_to_parquet.py')
   parser.add_argument('--output', required=False, default='iterations.pdf', metavar='defocus.pdf', type=str,
                       help='output file_name')
+  parser.add_argument('--force', required=False, default=False, action='store_true',
+                      help='plot even if the output is up to date with its inputs')
+  parser.add_argument('--checksum', required=False, default=False, action='store_true',
+                      help='also record input checksums so only a change of content makes the plot out of date')
   args = parser.parse_args()
   try:
     args.star_files.remove('run_it000_data.star') # classes > nclass
@@ -70,4 +99,14 @@ if __name__ == '__main__':
     pass
   if len([f for f in args.star_files if 'model' in f]) != len(args.star_files):
     sys.exit('Error: You need to give a list of run_itNNN_model.star files')
-  make_plot(star_files=args.star_files, output_file=args.output)
+  inputs = sorted(args.star_files)
+  inputs += [f.replace('_model_classes.parquet', '_model_general.parquet') for f in inputs if f.endswith('_model_classes.parquet')]
+  options = manifest_options(args, ['star_files'])
+  if not args.force and up_to_date(args.output, inputs, options):
+    print('{} is up to date (use --force to plot anyway)'.format(args.output))
+    sys.exit()
+  try:
+    make_plot(star_files=args.star_files, output_file=args.output)
+  except ValueError as e:
+    sys.exit('Sorry {}'.format(e))
+  write_manifest(args.output, inputs, options, args.checksum)
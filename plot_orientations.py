@@ -1,76 +1,167 @@
 #!/usr/bin/env python
 # Orientation plotter. Author: Huw Jenkins 12.11.24
+# Sampled quick-look mode 19.10.26
+# Read from stdin with - 19.10.26
+# orientation_histograms() for columns already loaded by another script 19.10.26
 from __future__ import print_function
+import sys
 import argparse 
+import tempfile
+from multiprocessing import Pool
 import numpy as np
 import matplotlib.pyplot as plt
+from star_io import read_parquet, open_star, read_star, read_headers, shard_lines, partial_name, add_shard_arguments, check_shard_arguments
+from sampling import sample_lines, percentile_ci, sample_rows
 
-def read_headers(star_file):
-  data = False
-  with open(star_file) as f:
-    for line in f:
-      if line[0:5] == 'data_' and line.strip()[5:] in ['', 'particles', 'micrographs']:
-        data = True
-        labels = []
-      elif data and line[0] == '_':
-        labels.append(line[line.find('_') + 1:line.find('#') - 1])
-      elif data and len(labels) > 0:
-        return labels
-      else:
-         continue 
+ANGLE_RANGES = {'Rot':(-180,180), 'Tilt':(0,180), 'Psi':(-180,180)}
 
-def make_plots(star_file, output_file, bins):
+def orientation_histograms(columns, bins):
+  # Histograms over the fixed plot ranges and (min, max) of each angle from already loaded
+  # columns ({label: numpy array})
+  counts = {}
+  ranges = {}
+  for ang in ANGLE_RANGES:
+    a = np.asarray(columns['rlnAngle' + ang], dtype=float)
+    counts[ang] = np.histogram(a, bins=bins, range=ANGLE_RANGES[ang])[0]
+    ranges[ang] = (np.min(a), np.max(a)) if a.size > 0 else (np.inf, -np.inf)
+  return counts, ranges
+
+def orientation_shard(star_file, bins, shard, nshards, partial_dir):
+  # map step: histograms over the fixed plot ranges and the extremes of each angle
   labels = read_headers(star_file)
-  r, t, p = labels.index('rlnAngleRot'), labels.index('rlnAngleTilt'), labels.index('rlnAnglePsi')
-  with open(star_file) as f:
-    rot = []
-    tilt = []
-    psi = []
-    data = False
-    for line in f:
-      if data and line.strip() != '':
-        items = line.split()
-        rot.append(float(items[r]))
-        tilt.append(float(items[t]))
-        psi.append(float(items[p]))
-      elif line.startswith('_' + labels[-1]):
-        data = True
-      else:
-        continue
+  index = {label:labels.index(label) for label in ['rlnAngleRot', 'rlnAngleTilt', 'rlnAnglePsi']}
+  columns = {label:[] for label in index}
+  for line in shard_lines(star_file, labels, shard, nshards):
+    items = line.split()
+    for label in index:
+      columns[label].append(float(items[index[label]]))
+  counts, ranges = orientation_histograms(columns, bins)
+  partial = {}
+  for ang in ANGLE_RANGES:
+    partial[ang] = counts[ang]
+    partial[ang + '_range'] = np.array(ranges[ang])
+  np.savez(partial_name(partial_dir, 'plot_orientations', star_file, shard, nshards, 'npz'), **partial)
+
+def read_partials(star_file, bins, nshards, partial_dir):
+  # reduce step: summed histograms and overall range of each angle
+  counts = {ang:np.zeros(bins, dtype=np.int64) for ang in ANGLE_RANGES}
+  ranges = {ang:[np.inf, -np.inf] for ang in ANGLE_RANGES}
+  for shard in range(nshards):
+    try:
+      partial = np.load(partial_name(partial_dir, 'plot_orientations', star_file, shard, nshards, 'npz'))
+    except IOError:
+      sys.exit('Sorry could not find results for shard {} of {} in {}'.format(shard + 1, nshards, partial_dir))
+    for ang in ANGLE_RANGES:
+      if partial[ang].size != bins:
+        sys.exit('Sorry shard {} was run with a different number of --bins'.format(shard + 1))
+      counts[ang] += partial[ang]
+      ranges[ang] = [min(ranges[ang][0], partial[ang + '_range'][0]), max(ranges[ang][1], partial[ang + '_range'][1])]
+  return counts, ranges
+
+def plot_histograms(counts, title=None):
+  # histograms from orientation_histograms (or summed over shards) on the current figure, drawn by
+  # weighting the bin centres
+  kwargs = dict(color='#0072b2', histtype='stepfilled', edgecolor='none', alpha=0.75)
+  for row, ang, ticks in [(0, 'Rot', [-180, -135, -90, -45, 0, 45, 90, 135, 180]),
+                          (5, 'Tilt', [0, 45, 90, 135, 180]),
+                          (10, 'Psi', [-180, -135, -90, -45, 0, 45, 90, 135, 180])]:
+    bins = len(counts[ang])
+    plt.subplot2grid((15,1), (row,0), rowspan=3)
+    if row == 0 and title is not None:
+      plt.title(title, fontsize=10)
+    plt.hist(np.linspace(*ANGLE_RANGES[ang], num=2*bins + 1)[1::2], range=ANGLE_RANGES[ang], bins=bins, weights=counts[ang], **kwargs)
+    plt.xticks(ticks=ticks)
+    plt.xlabel('rlnAngle' + ang)
+    plt.ylabel('No. particles')
+
+def make_plots(star_file, output_file, bins, sample=None, fraction=None, seed=0, nshards=None, partial_dir=None):
+  if star_file.endswith('.parquet') or partial_dir is not None:
+    labels = read_headers(star_file)
+  else:
+    f = open_star(star_file)
+    header, labels, lines = read_star(f, ['', 'particles', 'micrographs'])
+  index = [labels.index('rlnAngleRot'), labels.index('rlnAngleTilt'), labels.index('rlnAnglePsi')]
+  sampled = sample is not None or fraction is not None
+  if partial_dir is not None:
+    counts, ranges = read_partials(star_file, bins, nshards, partial_dir)
+  else:
+    if star_file.endswith('.parquet'):
+      table = read_parquet(star_file).read(columns=[labels[i] for i in index])
+      columns = {label:table.column(label).to_numpy() for label in table.column_names}
+      if sampled:
+        n_rows = table.num_rows
+        rows = sample_rows(n_rows, sample, fraction, seed)
+        columns = {label:c[rows] for label, c in columns.items()}
+        print('Sampled {} of {} particles from {}'.format(len(rows), n_rows, star_file))
+        if len(rows) == 0:
+          sys.exit('Sorry the sample of {} is empty'.format(star_file))
+    else:
+      with f:
+        if sampled:
+          lines, n_rows = sample_lines(lines, sample, fraction, seed)
+          print('Sampled {} of {} particles from {}'.format(len(lines), n_rows, star_file))
+          if len(lines) == 0:
+            sys.exit('Sorry the sample of {} is empty'.format(star_file))
+        values = [[] for i in index]
+        for line in lines:
+          items = line.split()
+          for v, i in zip(values, index):
+            v.append(float(items[i]))
+      columns = {labels[i]:np.array(v) for i, v in zip(index, values)}
+    counts, ranges = orientation_histograms(columns, bins)
 
-  r = np.array(rot)
-  t = np.array(tilt)
-  p = np.array(psi)
-  kwargs = dict(color='#0072b2', histtype='stepfilled', edgecolor='none', alpha=0.75, bins=bins)
-  plt.subplot2grid((15,1), (0,0), rowspan=3)
-  plt.hist(r, range=(-180,180), **kwargs)
-  plt.xticks(ticks=[-180, -135, -90, -45, 0, 45, 90, 135, 180])
-  plt.xlabel('rlnAngleRot')
-  plt.ylabel('No. particles')
-  plt.subplot2grid((15,1), (5,0), rowspan=3)
-  plt.hist(t, range=(0,180), **kwargs)
-  plt.xticks(ticks=[0, 45, 90, 135, 180])
-  plt.xlabel('rlnAngleTilt')
-  plt.ylabel('No. particles')
-  plt.subplot2grid((15,1), (10,0), rowspan=3)
-  plt.hist(p, range=(-180,180), **kwargs)
-  plt.xticks(ticks=[-180, -135, -90, -45, 0, 45, 90, 135, 180])
-  plt.xlabel('rlnAnglePsi')
-  plt.ylabel('No. particles')
-  d = {'Rot':r, 'Tilt':t, 'Psi':p}
-  for ang in d:
-    print(f'Range of rlnAngle{ang}: {np.min(d[ang]):0.2f} - {np.max(d[ang]):0.2f}')
+  for ang in ANGLE_RANGES:
+    print(f'Range of rlnAngle{ang}: {ranges[ang][0]:0.2f} - {ranges[ang][1]:0.2f}')
+  title = None
+  if sampled:
+    pct = [5, 25, 50, 75, 95]
+    print('Percentiles with 95% CI from sample:')
+    for ang in ANGLE_RANGES:
+      d = columns['rlnAngle' + ang]
+      pc = np.percentile(d, pct)
+      lo, hi = percentile_ci(d, pct)
+      print(f'rlnAngle{ang}: ' + ', '.join(f'{p}%: {pc[j]:0.1f} ({lo[j]:0.1f} - {hi[j]:0.1f})' for j, p in enumerate(pct)))
+    title = 'Sampled {} of {} particles'.format(len(columns['rlnAngleRot']), n_rows)
   print('Writing orientation results to {}'.format(output_file))
+  plot_histograms(counts, title)
   plt.savefig(output_file, format='pdf')
   plt.close()
 
 if __name__=='__main__':
   parser = argparse.ArgumentParser(description='Plot range of orientations in star file')
   parser.add_argument('star_file', metavar='[run_data.star]', type=str,
-                      help='star file from Refine3D or Class3D')
+                      help='star file from Refine3D or Class3D (- for stdin)')
   parser.add_argument('--output', required=False, default='orientations.pdf', metavar='orientations.pdf', type=str,
                       help='output file_name')
   parser.add_argument('--bins', required=False, default=180, metavar='180', type=int,
                       help='number of bins in histogram')
+  sampling = parser.add_mutually_exclusive_group(required=False)
+  sampling.add_argument('--sample', required=False, default=None, metavar='100000', type=int,
+                      help='quick look: plot a random sample of this many particles')
+  sampling.add_argument('--fraction', required=False, default=None, metavar='0.01', type=float,
+                      help='quick look: plot this fraction of particles')
+  parser.add_argument('--seed', required=False, default=0, metavar='0', type=int,
+                      help='random seed for --sample or --fraction')
+  add_shard_arguments(parser)
   args = parser.parse_args()
-  make_plots(star_file=args.star_file, output_file=args.output, bins=args.bins)
+  if args.sample is not None and args.sample < 1:
+    sys.exit('Error: --sample must be at least 1')
+  if args.fraction is not None and not 0.0 < args.fraction <= 1.0:
+    sys.exit('Error: --fraction must be between 0 and 1')
+  sharded = args.shard is not None or args.reduce or (args.nproc is not None and args.nproc > 1)
+  if sharded and (args.sample is not None or args.fraction is not None):
+    sys.exit('Error: --sample and --fraction cannot be used with sharding')
+  if sharded and args.star_file == '-':
+    sys.exit('Error: sharding needs a star file rather than stdin')
+  check_shard_arguments(args, [args.star_file])
+  if args.shard is not None:
+    orientation_shard(args.star_file, args.bins, args.shard - 1, args.nshards, args.partial_dir)
+  elif args.reduce:
+    make_plots(star_file=args.star_file, output_file=args.output, bins=args.bins, nshards=args.nshards, partial_dir=args.partial_dir)
+  elif sharded and not args.star_file.endswith('.parquet'):
+    with tempfile.TemporaryDirectory() as partial_dir:
+      with Pool(args.nproc) as pool:
+        pool.starmap(orientation_shard, [(args.star_file, args.bins, shard, args.nproc, partial_dir) for shard in range(args.nproc)])
+      make_plots(star_file=args.star_file, output_file=args.output, bins=args.bins, nshards=args.nproc, partial_dir=partial_dir)
+  else:
+    make_plots(star_file=args.star_file, output_file=args.output, bins=args.bins, sample=args.sample, fraction=args.fraction, seed=args.seed)
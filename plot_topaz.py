@@ -4,33 +4,28 @@
 # Author Huw Jenkins 061223
 # 081124 add Table of No. particles at various FOM thresholds
 # 081124 Allow plotting multiple training runs.
+# 191026 Sampled quick-look mode for FOM plot
+# 191026 Only re-plot when inputs or options change (output.manifest.json)
+# 191026 Checkpoint so only coordinate files added since the last run are read for the FOM plot
+# 191026 read_foms(), fom_histogram() and training_auprc() for use from other scripts
 
 from __future__ import print_function
 import os
 import sys
+import json
+import math
 import argparse
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator
-
-def read_headers(star_file):
-  data = False
-  with open(star_file) as f:
-    for line in f:
-      if line[0:5] == 'data_' and line.strip()[5:] in ['', 'coordinate_files']:
-        data = True
-        labels = []
-      elif data and line[0] == '_':
-        labels.append(line[line.find('_') + 1:line.find('#') - 1])
-      elif data and len(labels) > 0:
-        return labels
-      else:
-         continue
+from manifest import manifest_options, up_to_date, write_manifest
+from sampling import sample_lines
+from star_io import read_headers, data_lines
 
 def get_star_files(star_file):
   star_files = []
-  labels=read_headers(star_file)
+  labels=read_headers(star_file, ['', 'coordinate_files'])
   sf = labels.index('rlnMicrographCoordinates')
   with open(star_file) as f:
     data = False
@@ -56,38 +51,114 @@ def get_job_type(star_file):
     sys.exit("Sorry {} doesn't appear to be from a Topaz training or auto-picking job".format(star_file))
   return job, n
 
-def make_FOM_plot(star_file, output_file, min, max, bins):
-  foms = []
-  star_files = get_star_files(star_file)
-  print('Reading FOMs from {} star files...'.format(len(star_files)))
+def fom_lines(star_files):
   for sf in star_files:
-    labels=read_headers(sf)
+    labels=read_headers(sf, ['', 'coordinate_files'])
     fom = labels.index('rlnAutopickFigureOfMerit')
     with open(sf) as f:
-      data = False
-      for line in f:
-        if data and line.strip() != '':
-          items = line.split()
-          foms.append(float(items[fom]))
-        elif line.startswith('_' + labels[-1]):
-          data = True
-        else:
-          continue
-  print('Plotting histogram of FOM from {} picks from {} micrographs...'.format(len(foms), len(star_files)))
-  a = np.array(foms)
-  print(' FOM  No. ptcls')
-  for t in [0.0, -1.0, -1.5,  -2.0, -2.5, -3.0, -3.5, -4.0, -4.5, -5, -6]:
-      print(f"{'{:4.1f}'.format(t):>3} {np.sum(a>t):7d}")
+      for line in data_lines(f, labels):
+        yield line, fom
+
+THRESHOLDS = [0.0, -1.0, -1.5,  -2.0, -2.5, -3.0, -3.5, -4.0, -4.5, -5, -6]
+
+def read_foms(star_files):
+  return np.array([float(line.split()[fom]) for line, fom in fom_lines(star_files)])
+
+def fom_histogram(foms, min, max, bins):
+  # histogram of an array of FOMs over (min, max) and the number of picks above each of THRESHOLDS
+  counts = np.histogram(foms, bins=bins, range=(min, max))[0]
+  above = np.array([np.sum(foms>t) for t in THRESHOLDS])
+  return counts, above
+
+def read_FOM_checkpoint(checkpoint_file, star_files, min, max, bins):
+  # Histogram and threshold counts from the coordinate files read by earlier runs. They are only
+  # used if the histogram range is the same and none of those files has changed size since.
+  state = {'min':min, 'max':max, 'bins':bins, 'files':{}, 'counts':[0] * bins, 'above':[0] * len(THRESHOLDS), 'picks':0}
+  try:
+    with open(checkpoint_file) as f:
+      saved = json.load(f)
+  except (IOError, ValueError):
+    return state
+  if [saved.get('min'), saved.get('max'), saved.get('bins')] != [min, max, bins]:
+    return state
+  listed = set(star_files)
+  for sf, size in saved['files'].items():
+    if sf not in listed or not os.path.isfile(sf) or os.path.getsize(sf) != size:
+      return state
+  return saved
+
+def update_FOM_checkpoint(checkpoint_file, star_files, min, max, bins):
+  state = read_FOM_checkpoint(checkpoint_file, star_files, min, max, bins)
+  new_files = [sf for sf in star_files if sf not in state['files']]
+  if len(state['files']) > 0:
+    print('Read {} picks from {} star files in {}'.format(state['picks'], len(state['files']), checkpoint_file))
+  print('Reading FOMs from {} new star files...'.format(len(new_files)))
+  a = read_foms(new_files)
+  counts, above = fom_histogram(a, min, max, bins)
+  state['counts'] = (np.array(state['counts']) + counts).tolist()
+  state['above'] = (np.array(state['above']) + above).tolist()
+  state['picks'] += a.size
+  state['files'].update({sf:os.path.getsize(sf) for sf in new_files})
+  with open(checkpoint_file + '.tmp', 'w') as f:
+    json.dump(state, f)
+  os.replace(checkpoint_file + '.tmp', checkpoint_file)
+  return state
+
+def plot_FOM(counts, min, max, output_file, title=None):
+  # histogram from fom_histogram (or a checkpoint) drawn by weighting the bin centres
+  bins = len(counts)
   fig, ax1 = plt.subplots()
-  ax1.hist(a, bins=bins, range=(min, max))
+  ax1.hist(np.linspace(min, max, num=2*bins + 1)[1::2], bins=bins, range=(min, max), weights=counts)
+  if title is not None:
+    ax1.set_title(title, fontsize=10)
   ax1.set_xlabel('Predicted score (predicted log-likelihood ratio)')
   ax1.set_ylabel('Number of particles')
   ax1.xaxis.set_minor_locator(AutoMinorLocator())
   plt.grid(True)
   plt.savefig(output_file, format='pdf')
-  print('...written plot to {}'.format(output_file))
   plt.close()
 
+def make_FOM_plot(star_file, output_file, min, max, bins, sample=None, fraction=None, seed=0, checkpoint=None):
+  star_files = get_star_files(star_file)
+  sampled = sample is not None or fraction is not None
+  if checkpoint is not None:
+    state = update_FOM_checkpoint(checkpoint, star_files, min, max, bins)
+    counts, above = np.array(state['counts']), np.array(state['above'])
+    n_plotted = state['picks']
+  else:
+    print('Reading FOMs from {} star files...'.format(len(star_files)))
+    lines = fom_lines(star_files)
+    if sampled:
+      lines, n_picks = sample_lines(lines, sample, fraction, seed)
+      print('Sampled {} of {} picks'.format(len(lines), n_picks))
+      if len(lines) == 0:
+        sys.exit('Sorry the sample is empty')
+    a = np.array([float(line.split()[fom]) for line, fom in lines])
+    counts, above = fom_histogram(a, min, max, bins)
+    n_plotted = a.size
+  print('Plotting histogram of FOM from {} picks from {} micrographs...'.format(n_plotted, len(star_files)))
+  if sampled:
+    # scale counts in sample to all picks with 95% binomial error
+    print(' FOM  No. ptcls (estimated)')
+    for t, n in zip(THRESHOLDS, above):
+      p = n / a.size
+      err = 1.96 * n_picks * math.sqrt(p * (1.0 - p) / a.size)
+      print(f"{'{:4.1f}'.format(t):>3} {p * n_picks:7.0f} +/- {err:.0f}")
+  else:
+    print(' FOM  No. ptcls')
+    for t, n in zip(THRESHOLDS, above):
+        print(f"{'{:4.1f}'.format(t):>3} {n:7d}")
+  plot_FOM(counts, min, max, output_file, 'Sampled {} of {} picks'.format(a.size, n_picks) if sampled else None)
+  print('...written plot to {}'.format(output_file))
+  return counts, above
+
+def training_auprc(star_file):
+  # epochs and area under the precision-recall curve on the validation set of a training job
+  results_file = os.path.join(os.path.split(star_file)[0],'model_training.txt')
+  table = pd.read_csv(results_file, sep='\t')
+  table = table.loc[table['split'] == 'test'] # only keep the validation results
+  return table['epoch'].to_numpy(), table['auprc'].astype(float).to_numpy()
+
 def make_training_plot(star_files, n, output_file):
   fig, ax = plt.subplots()
   for star_file, n in zip(star_files,n):
@@ -96,12 +167,9 @@ def make_training_plot(star_files, n, output_file):
       print('WARNING RELION sets the default number of expected particles to 200 but *you* should have set this!')
       print('WARNING Topaz training quality is highly dependent on the value for the number of expected particles')
       print('WARNING You should optimise the choice of value for the number of expected particles!')
-    results_file = os.path.join(os.path.split(star_file)[0],'model_training.txt')
-    table = pd.read_csv(results_file, sep='\t')
-    table = table.loc[table['split'] == 'test'] # only keep the validation results
-    table['auprc'] = table['auprc'].astype(float)
-    print('Plotting area under the precision-recall curve for {} epochs of training...'.format(len(table)))
-    ax.plot(table['epoch'], table['auprc'], '-o',  label=str(n))
+    epochs, auprc = training_auprc(star_file)
+    print('Plotting area under the precision-recall curve for {} epochs of training...'.format(len(epochs)))
+    ax.plot(epochs, auprc, '-o',  label=str(n))
   ax.set_xlabel('Epoch')
   ax.set_ylabel('AUPRC')
   ax.legend(loc='best')
@@ -109,7 +177,23 @@ def make_training_plot(star_files, n, output_file):
   print('...written plot to {}'.format(output_file))
   plt.close()
 
-def make_plot(star_files, output_file, min, max, bins):
+def plot_inputs(star_files, output_file):
+  # output file as chosen by make_plot and the files the plot is made from
+  if len(star_files) > 1:
+    return 'topaz_training.pdf', star_files + [os.path.join(os.path.split(sf)[0], 'model_training.txt') for sf in star_files]
+  star_file = star_files[0]
+  job, n = get_job_type(star_file)
+  job_dir = os.path.split(star_file)[0]
+  if job == 'relion.autopick.topaz.pick':
+    if output_file == 'topaz.pdf':
+      output_file = os.path.join(job_dir, 'topaz_FOM.pdf')
+    autopick = os.path.join(job_dir, 'autopick.star')
+    return output_file, [star_file, autopick] + get_star_files(autopick)
+  if output_file == 'topaz.pdf':
+    output_file = os.path.join(job_dir, 'topaz_training.pdf')
+  return output_file, [star_file, os.path.join(job_dir, 'model_training.txt')]
+
+def make_plot(star_files, output_file, min, max, bins, sample=None, fraction=None, seed=0, checkpoint=None):
   if len(star_files) == 1:
     star_file=star_files[0]
     job, n = get_job_type(star_file)
@@ -120,7 +204,7 @@ def make_plot(star_files, output_file, min, max, bins):
         output_file = os.path.join(os.path.split(star_file)[0], 'topaz_training.pdf')
     if job == 'relion.autopick.topaz.pick':
       star_file = os.path.join(os.path.split(star_file)[0],'autopick.star')
-      make_FOM_plot(star_file, output_file, min, max, bins)
+      make_FOM_plot(star_file, output_file, min, max, bins, sample, fraction, seed, checkpoint)
     elif job == 'relion.autopick.topaz.train':
       make_training_plot(star_files, [n], output_file)
   else:
@@ -144,7 +228,26 @@ if __name__=='__main__':
                       help='maximum score for FOM plot')
   parser.add_argument('--bins', required=False, default=50, metavar='50', type=int,
                       help='number of bins in FOM histogram')
+  sampling = parser.add_mutually_exclusive_group(required=False)
+  sampling.add_argument('--sample', required=False, default=None, metavar='100000', type=int,
+                      help='quick look: plot FOM of a random sample of this many picks')
+  sampling.add_argument('--fraction', required=False, default=None, metavar='0.01', type=float,
+                      help='quick look: plot FOM of this fraction of picks')
+  parser.add_argument('--seed', required=False, default=0, metavar='0', type=int,
+                      help='random seed for --sample or --fraction')
+  parser.add_argument('--checkpoint', required=False, default=None, metavar='topaz_FOM.json', type=str,
+                      help='keep the FOM histogram in this file and only read coordinate files added since the last run')
+  parser.add_argument('--force', required=False, default=False, action='store_true',
+                      help='plot even if the output is up to date with its inputs')
+  parser.add_argument('--checksum', required=False, default=False, action='store_true',
+                      help='also record input checksums so only a change of content makes the plot out of date')
   args = parser.parse_args()
+  if args.sample is not None and args.sample < 1:
+    sys.exit('Error: --sample must be at least 1')
+  if args.fraction is not None and not 0.0 < args.fraction <= 1.0:
+    sys.exit('Error: --fraction must be between 0 and 1')
+  if args.checkpoint is not None and (args.sample is not None or args.fraction is not None):
+    sys.exit('Error: --checkpoint cannot be used with --sample or --fraction')
   for star_file in args.star_files:
     if not os.path.split(star_file)[0].startswith('AutoPick'):
       sys.exit('Please run this script from the RELION job directory and supply the path to the job.star file as Autopick/jobNNN/job.star')
@@ -152,4 +255,11 @@ if __name__=='__main__':
       sys.exit('Please run this script from the RELION job directory and supply the path to the job.star file as Autopick/jobNNN/job.star')
     if not os.path.isfile(star_file):
       sys.exit('Could not find {}'.format(star_file))
-  make_plot(star_files=args.star_files, output_file=args.output, min=args.min, max=args.max, bins=args.bins)
+  output_file, inputs = plot_inputs(args.star_files, args.output)
+  options = manifest_options(args, ['star_files', 'checkpoint'])
+  if not args.force and up_to_date(output_file, inputs, options):
+    print('{} is up to date (use --force to plot anyway)'.format(output_file))
+    sys.exit()
+  make_plot(star_files=args.star_files, output_file=output_file, min=args.min, max=args.max, bins=args.bins,
+            sample=args.sample, fraction=args.fraction, seed=args.seed, checkpoint=args.checkpoint)
+  write_manifest(output_file, inputs, options, args.checksum)
@@ -0,0 +1,61 @@
+# Sampled quick-look plots, shared by plot_defocus.py, plot_orientations.py and plot_topaz.py: --sample/--fraction
+# selection of star file lines or Parquet rows and confidence intervals on percentiles of the sample. 19.10.26
+import sys
+import math
+import random
+from itertools import islice
+import numpy as np
+
+def sample_lines(lines, sample, fraction, seed):
+  # Only the selected lines are kept so unselected rows are never split or converted.
+  # A fixed size sample uses reservoir sampling (Algorithm L: Li, ACM TOMS 20:481 1994)
+  # a fraction takes every 1/fraction'th line from a random start. If there are fewer lines than
+  # 1/fraction and the start is past the end, one of the lines chosen at random is kept instead.
+  rng = random.Random(seed)
+  if fraction is not None:
+    step = max(1, int(round(1.0 / fraction)))
+    start = rng.randrange(step)
+    kept = []
+    spare = None
+    n = 0
+    for line in lines:
+      if n % step == start:
+        kept.append(line)
+      elif not kept and rng.randrange(n + 1) == 0:
+        spare = line
+      n += 1
+    return kept or [spare][:n], n
+  kept = list(islice(lines, sample))
+  n = len(kept)
+  if n < sample:
+    return kept, n
+  w = math.exp(math.log(1.0 - rng.random()) / sample)
+  while True:
+    skip = int(math.log(1.0 - rng.random()) / math.log(1.0 - w))
+    skipped = sum(1 for _ in islice(lines, skip))
+    n += skipped
+    line = next(lines, None) if skipped == skip else None
+    if line is None:
+      return kept, n
+    n += 1
+    kept[rng.randrange(sample)] = line
+    w *= math.exp(math.log(1.0 - rng.random()) / sample)
+
+def percentile_ci(d, pct):
+  # 95% confidence interval on percentiles of a sample from binomial order statistics
+  if len(d) == 0:
+    sys.exit('Sorry the sample is empty')
+  s = np.sort(d)
+  p = np.array(pct) / 100.0
+  half = 1.96 * np.sqrt(s.size * p * (1.0 - p))
+  lo = np.clip(np.floor(s.size * p - half).astype(int), 0, s.size - 1)
+  hi = np.clip(np.ceil(s.size * p + half).astype(int), 0, s.size - 1)
+  return s[lo], s[hi]
+
+def sample_rows(n_rows, sample, fraction, seed):
+  # row indices for --sample or --fraction when whole columns have been read
+  rng = np.random.default_rng(seed)
+  if fraction is not None:
+    step = max(1, int(round(1.0 / fraction)))
+    return np.arange(rng.integers(max(1, min(step, n_rows))), n_rows, step)
+  return np.sort(rng.choice(n_rows, min(sample, n_rows), replace=False))
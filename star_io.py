@@ -0,0 +1,136 @@
+# Reading RELION star files and star files converted with star_to_parquet.py, shared by the counting, plotting
+# and cleaning scripts. Star files are read in a single pass (so they can come from a pipe) or in byte range
+# shards for multiprocessing or cluster jobs, with the shard options shared by those scripts. 19.10.26
+import os
+import sys
+import hashlib
+from itertools import chain
+
+def read_parquet(parquet_file):
+  # star file converted with star_to_parquet.py
+  try:
+    import pyarrow.parquet as pq
+  except ImportError:
+    sys.exit('Sorry reading {} requires pyarrow'.format(parquet_file))
+  return pq.ParquetFile(parquet_file)
+
+def open_star(star_file):
+  # '-' reads the star file from stdin
+  if star_file == '-':
+    return open(sys.stdin.fileno(), closefd=False)
+  return open(star_file)
+
+def read_star(f, blocks=['', 'particles']):
+  # Header lines, labels and data lines of the loop in blocks from a single pass over f
+  # so the star file can be read from a pipe
+  header = []
+  labels = None
+  for line in f:
+    if labels and line[0] not in '_#' and line.strip() != '':
+      return header, labels, chain([line], (line for line in f if line.strip() != ''))
+    header.append(line)
+    if line[0:5] == 'data_':
+      labels = [] if line.strip()[5:] in blocks else None
+    elif labels is not None and line[0] == '_':
+      labels.append(line[line.find('_') + 1:line.find('#') - 1])
+  return header, labels or [], iter([])
+
+def read_headers(star_file, blocks=['', 'particles']):
+  # labels of the first loop in blocks
+  if star_file.endswith('.parquet'):
+    return read_parquet(star_file).schema_arrow.names
+  data = False
+  with open(star_file) as f:
+    for line in f:
+      if line[0:5] == 'data_' and line.strip()[5:] in blocks:
+        data = True
+        labels = []
+      elif data and line[0] == '_':
+        labels.append(line[line.find('_') + 1:line.find('#') - 1])
+      elif data and len(labels) > 0:
+        return labels
+      else:
+         continue
+
+def data_lines(f, labels):
+  data = False
+  for line in f:
+    if data and line.strip() != '':
+      yield line
+    elif line.startswith('_' + labels[-1]):
+      data = True
+
+def pass_lines(lines, out):
+  # write each line on to out as it is read
+  for line in lines:
+    out.write(line)
+    yield line
+
+def data_offset(star_file, labels):
+  # byte offset of the first data line of the loop with labels
+  with open(star_file, 'rb') as f:
+    data = False
+    pos = 0
+    for line in f:
+      if data and line.strip() != b'':
+        return pos
+      elif line.startswith(b'_' + labels[-1].encode()):
+        data = True
+      pos += len(line)
+  return pos
+
+def shard_lines(star_file, labels, shard, nshards):
+  # Data lines starting in this shard's share of the bytes after the header. The first line is
+  # skipped unless it starts exactly on the boundary as it belongs to the previous shard.
+  start = data_offset(star_file, labels)
+  size = os.path.getsize(star_file)
+  begin = start + (size - start) * shard // nshards
+  end = start + (size - start) * (shard + 1) // nshards
+  with open(star_file, 'rb') as f:
+    f.seek(begin)
+    pos = begin
+    if begin > start:
+      f.seek(begin - 1)
+      pos += len(f.readline()) - 1
+    while pos < end:
+      line = f.readline()
+      if not line:
+        break
+      pos += len(line)
+      if line.strip() != b'':
+        yield line.decode()
+
+def add_shard_arguments(parser):
+  # --nproc, --nshards, --shard, --reduce and --partial_dir of the scripts that read star files in shards
+  parser.add_argument('--nproc', required=False, default=None, metavar='8', type=int,
+                      help='split each data block into this many shards and read them in parallel')
+  parser.add_argument('--nshards', required=False, default=None, metavar='8', type=int,
+                      help='number of shards when running --shard or --reduce as separate (cluster) jobs')
+  sharding = parser.add_mutually_exclusive_group(required=False)
+  sharding.add_argument('--shard', required=False, default=None, metavar='1', type=int,
+                      help='read shard N of --nshards and write its partial result to --partial_dir')
+  sharding.add_argument('--reduce', required=False, default=False, action='store_true',
+                      help='merge the partial results in --partial_dir')
+  parser.add_argument('--partial_dir', required=False, default=None, metavar='partials', type=str,
+                      help='directory for partial results from each shard')
+
+def check_shard_arguments(args, star_files):
+  # exit if --shard or --reduce are given without the options they need and make --partial_dir for --shard
+  if args.shard is not None or args.reduce:
+    if args.nshards is None or args.partial_dir is None:
+      sys.exit('Error: --shard and --reduce need --nshards and --partial_dir')
+    if len([f for f in star_files if f.endswith('.parquet')]) > 0:
+      sys.exit('Error: sharding is only supported for star files')
+  if args.shard is not None:
+    if not 1 <= args.shard <= args.nshards:
+      sys.exit('Error: --shard must be between 1 and --nshards')
+    if not os.path.isdir(args.partial_dir):
+      os.makedirs(args.partial_dir, exist_ok=True)
+
+def partial_name(partial_dir, program, star_files, shard, nshards, extension):
+  # Partial result of a shard of one or more star files. The name includes a hash of the full paths so star
+  # files with the same name from different jobs can share a --partial_dir.
+  if isinstance(star_files, str):
+    star_files = [star_files]
+  digest = hashlib.blake2b('\n'.join(os.path.abspath(f) for f in star_files).encode(), digest_size=6).hexdigest()
+  return os.path.join(partial_dir, '{}_{}_{}_{}of{}.{}'.format(program, os.path.split(star_files[0])[1], digest, shard + 1, nshards, extension))
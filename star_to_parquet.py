@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# Convert RELION star files to Parquet so scripts can read only the columns they use. 19.10.26
+# Each data block is written to its own file: run_data.star -> run_data_optics.parquet, run_data_particles.parquet
+# Blocks without a loop (e.g. data_general in postprocess.star) become a table with a single row.
+# Columns are widened when a later row group does not fit the type of the first and output only replaces existing
+# files once the whole star file has been converted. 19.10.26
+import os
+import sys
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+def parquet_name(star_file, block, output_dir):
+  stem = os.path.splitext(os.path.split(star_file)[1])[0]
+  if output_dir is None:
+    output_dir = os.path.split(star_file)[0]
+  if block != '':
+    stem = '{}_{}'.format(stem, block)
+  return os.path.join(output_dir, stem + '.parquet')
+
+TYPES = [np.int64, np.float64, str] # narrowest first
+
+def column_types(rows):
+  # int64 if every value in rows is an integer, float64 if numeric, otherwise string
+  types = []
+  for col in zip(*rows):
+    a = np.array(col)
+    for t in TYPES[:2]:
+      try:
+        a.astype(t)
+        types.append(t)
+        break
+      except ValueError:
+        continue
+    else:
+      types.append(str)
+  return types
+
+def arrow_type(t):
+  return pa.string() if t is str else pa.from_numpy_dtype(t)
+
+def to_table(labels, rows, types):
+  # None if a column does not fit its type
+  arrays = []
+  for col, t in zip(zip(*rows), types):
+    try:
+      arrays.append(pa.array(np.array(col).astype(t)) if t is not str else pa.array(col, type=pa.string()))
+    except ValueError:
+      return None
+  return pa.Table.from_arrays(arrays, names=labels)
+
+class BlockWriter:
+  # Rows of one loop written in row groups to output_file.tmp, renamed to output_file by convert()
+  def __init__(self, output_file, labels, row_group_size):
+    self.output_file = output_file
+    self.temp_file = output_file + '.tmp'
+    self.labels = labels
+    self.row_group_size = row_group_size
+    self.rows = []
+    self.types = None
+    self.writer = None
+    self.n = 0
+
+  def add(self, items):
+    if len(items) != len(self.labels):
+      sys.exit('Sorry row {} of {} has {} values for {} labels'.format(self.n + 1, self.output_file, len(items), len(self.labels)))
+    self.rows.append(items)
+    self.n += 1
+    if len(self.rows) == self.row_group_size:
+      self.flush()
+
+  def flush(self):
+    if len(self.rows) == 0:
+      return
+    if self.types is None:
+      self.types = column_types(self.rows)
+    table = to_table(self.labels, self.rows, self.types)
+    if table is None:
+      self.widen(column_types(self.rows))
+      table = to_table(self.labels, self.rows, self.types)
+    if self.writer is None:
+      self.writer = pq.ParquetWriter(self.temp_file, table.schema, write_statistics=True)
+    self.writer.write_table(table, row_group_size=self.row_group_size)
+    self.rows = []
+
+  def widen(self, types):
+    # Rewrite the row groups already written with types that also fit the current rows. Conversion to
+    # string writes earlier numbers as pyarrow formats them (e.g. 2.000000 becomes 2).
+    types = [TYPES[max(TYPES.index(a), TYPES.index(b))] for a, b in zip(self.types, types)]
+    for label, a, b in zip(self.labels, self.types, types):
+      if a is not b:
+        print('Column _{} changes type after {} rows - written as {}'.format(label, self.n - len(self.rows), arrow_type(b)))
+    self.types = types
+    if self.writer is None:
+      return
+    self.writer.close()
+    os.replace(self.temp_file, self.temp_file + '.old')
+    pf = pq.ParquetFile(self.temp_file + '.old')
+    schema = pa.schema([(label, arrow_type(t)) for label, t in zip(self.labels, types)])
+    self.writer = pq.ParquetWriter(self.temp_file, schema, write_statistics=True)
+    for i in range(pf.num_row_groups):
+      self.writer.write_table(pf.read_row_group(i).cast(schema), row_group_size=self.row_group_size)
+    os.remove(self.temp_file + '.old')
+
+  def close(self):
+    self.flush()
+    if self.writer is not None:
+      self.writer.close()
+
+def sort_table(parquet_file, label, row_group_size):
+  # Rows sorted on e.g. rlnClassNumber give row groups with narrow min/max so readers can skip them.
+  # The whole table is sorted in memory so this needs about as much memory as the star file is large.
+  table = pq.read_table(parquet_file)
+  if label in table.schema.names:
+    pq.write_table(table.sort_by(label), parquet_file, row_group_size=row_group_size, write_statistics=True)
+
+def convert(star_file, output_dir, blocks, row_group_size, sort_by=None):
+  # Each block is written to a temporary file and all of them are renamed once the whole star
+  # file has been read so a failed conversion does not leave partial or mismatched Parquet files.
+  written = []
+  writers = []
+  writer = None
+  general = None
+  block = None
+  def finish():
+    if writer is not None:
+      writer.close()
+      if writer.n > 0:
+        written.append((writer, writer.n))
+    elif general is not None and len(general[0]) > 0:
+      w = BlockWriter(parquet_name(star_file, block, output_dir), general[0], 1)
+      writers.append(w)
+      w.add(general[1])
+      w.close()
+      written.append((w, 1))
+  try:
+    with open(star_file) as f:
+      for line in f:
+        s = line.strip()
+        if s == '' or s[0] == '#':
+          continue
+        if s.startswith('data_'):
+          finish()
+          writer = None
+          block = s[5:]
+          general = ([], []) if blocks is None or block in blocks else None
+        elif general is None and writer is None:
+          continue # block not selected
+        elif s.startswith('loop_'):
+          general = None
+          writer = BlockWriter(parquet_name(star_file, block, output_dir), [], row_group_size)
+          writers.append(writer)
+        elif s[0] == '_':
+          if writer is not None:
+            writer.labels.append(s.split()[0][1:])
+          else:
+            label, value = s.split(None, 1)
+            general[0].append(label[1:])
+            general[1].append(value.strip())
+        elif writer is not None:
+          writer.add(s.split())
+      finish()
+    if sort_by is not None:
+      for w, n in written:
+        sort_table(w.temp_file, sort_by, row_group_size)
+    for w, n in written:
+      os.replace(w.temp_file, w.output_file)
+  finally:
+    for w in writers:
+      for path in [w.temp_file, w.temp_file + '.old']:
+        if os.path.exists(path):
+          os.remove(path)
+  return [(w.output_file, n) for w, n in written]
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description='Convert RELION star files to Parquet with one file per data block')
+  parser.add_argument('star_files', metavar='run_data.star', type=str, nargs='+',
+                      help='star file(s) e.g. particles, micrographs_ctf, run_itNNN_model or postprocess')
+  parser.add_argument('--output_dir', required=False, default=None, metavar='Parquet', type=str,
+                      help='directory for Parquet files (default: next to each star file)')
+  parser.add_argument('--blocks', required=False, default=None, metavar='"optics,particles"', type=str,
+                      help='comma separated list of data blocks to convert (default: all)')
+  parser.add_argument('--row_group_size', required=False, default=250000, metavar='250000', type=int,
+                      help='rows per row group - min/max statistics are kept for each row group')
+  parser.add_argument('--sort_by', required=False, default=None, metavar='rlnClassNumber', type=str,
+                      help='sort tables containing this label so selections on it skip whole row groups - each table is sorted in memory')
+  args = parser.parse_args()
+  if args.output_dir is not None and not os.path.isdir(args.output_dir):
+    os.makedirs(args.output_dir)
+  blocks = args.blocks.split(',') if args.blocks is not None else None
+  for star_file in args.star_files:
+    for output_file, n in convert(star_file, args.output_dir, blocks, args.row_group_size, args.sort_by):
+      print('Written {} rows from {} to {}'.format(n, star_file, output_file))
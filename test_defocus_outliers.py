@@ -0,0 +1,22 @@
+import numpy as np
+from defocus_outliers import find_outliers
+
+def outliers(delta, nsigma=4):
+  n = len(delta)
+  reasons, centre, sigma = find_outliers(np.full(n, 10), np.array(delta, dtype=float), np.zeros(n), np.zeros(n), nsigma, None, None, 5)
+  return [i for i, r in enumerate(reasons) if 'delta' in r], centre, sigma
+
+def test_spread_of_deltas():
+  flagged, centre, sigma = outliers([-300, -100, 0, 50, 100, 200, 5000])
+  assert flagged == [6]
+  assert centre == 50
+
+def test_most_deltas_the_same():
+  # the MAD is 0 so any difference from the median would be flagged with it
+  flagged, centre, sigma = outliers([100, 100, 100, 100, 100, 100, 110, 90, 5000])
+  assert sigma > 0
+  assert flagged == [8]
+
+def test_all_deltas_the_same():
+  flagged, centre, sigma = outliers([100] * 6)
+  assert flagged == []
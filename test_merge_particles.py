@@ -0,0 +1,53 @@
+import numpy as np
+from merge_particles import merge_particles, image_duplicates, grid_keys, CELL_BITS
+
+def write_particles(path, particles):
+  # particles are (image name, micrograph, x, y)
+  with open(path, 'w') as f:
+    f.write('\n# version 30001\n\ndata_particles\n\nloop_ \n')
+    f.write('_rlnImageName #1 \n_rlnMicrographName #2 \n_rlnCoordinateX #3 \n_rlnCoordinateY #4 \n')
+    f.writelines('{} {} {} {}\n'.format(*p) for p in particles)
+  return str(path)
+
+def read_particles(path):
+  with open(path) as f:
+    return [line.split() for line in f if line[0].isdigit()]
+
+def merge(tmp_path, files, tolerance=None):
+  star_files = [write_particles(tmp_path / 'in{}.star'.format(i), particles) for i, particles in enumerate(files)]
+  output = str(tmp_path / 'merged.star')
+  merge_particles(star_files, output, str(tmp_path / 'report.txt'), tolerance)
+  return read_particles(output)
+
+def test_duplicates_of_removed_particles_are_kept(tmp_path):
+  # (108, 100) is a duplicate of (100, 100) but (116, 100) is only close to (108, 100) which is removed
+  merged = merge(tmp_path, [[('1@a.mrcs', 'mic1.mrc', 100, 100)],
+                            [('2@a.mrcs', 'mic1.mrc', 108, 100), ('3@a.mrcs', 'mic1.mrc', 116, 100)]], tolerance=10)
+  assert [p[0] for p in merged] == ['1@a.mrcs', '3@a.mrcs']
+
+def test_chain_within_one_file(tmp_path):
+  merged = merge(tmp_path, [[('1@a.mrcs', 'mic1.mrc', 100, 100), ('2@a.mrcs', 'mic1.mrc', 108, 100),
+                             ('3@a.mrcs', 'mic1.mrc', 116, 100), ('4@a.mrcs', 'mic2.mrc', 100, 100)]], tolerance=10)
+  assert [p[0] for p in merged] == ['1@a.mrcs', '3@a.mrcs', '4@a.mrcs']
+
+def test_negative_coordinates(tmp_path):
+  merged = merge(tmp_path, [[('1@a.mrcs', 'mic1.mrc', -3, -3)],
+                            [('2@a.mrcs', 'mic1.mrc', 2, 2), ('3@a.mrcs', 'mic1.mrc', -3, 5000), ('4@a.mrcs', 'mic2.mrc', -3, -3)]], tolerance=10)
+  assert [p[0] for p in merged] == ['1@a.mrcs', '3@a.mrcs', '4@a.mrcs']
+
+def test_neighbouring_cells_do_not_carry_into_other_fields():
+  keys = grid_keys(np.array([0, 0, 1]), np.array([0.0, 10.0, 0.0]), np.array([-10.0, 0.0, -10.0]), 10)
+  assert keys[1] == keys[0] + (1 << CELL_BITS) + 1
+  assert keys[2] - keys[0] == 1 << (2 * CELL_BITS)
+
+def test_same_image_name(tmp_path):
+  merged = merge(tmp_path, [[('1@a.mrcs', 'mic1.mrc', 100, 100), ('2@a.mrcs', 'mic1.mrc', 500, 500)],
+                            [('2@a.mrcs', 'mic1.mrc', 500, 500), ('3@a.mrcs', 'mic1.mrc', 900, 900), ('3@a.mrcs', 'mic1.mrc', 900, 900)]])
+  assert [p[0] for p in merged] == ['1@a.mrcs', '2@a.mrcs', '3@a.mrcs']
+
+def test_names_are_compared_when_digests_match():
+  # an index entry with the digest of 1@a.mrcs but a different name is not a duplicate
+  index = image_duplicates((np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int16), np.zeros(0, dtype=bytes)), ['1@a.mrcs'], 0)[1]
+  index = (index[0], index[1], np.array([b'9@b.mrcs']))
+  partner = image_duplicates(index, ['1@a.mrcs'], 1)[0]
+  assert partner.tolist() == [-1]
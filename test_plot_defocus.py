@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from plot_defocus import micrograph_columns, class_defocus
+
+LABELS = ['rlnMicrographName', 'rlnDefocusU', 'rlnDefocusV', 'rlnCtfMaxResolution']
+
+def write_micrographs(path, n):
+  # micrographs_ctf.star as RELION writes it, with a blank line after the loop
+  with open(path, 'w') as f:
+    f.write('\n# version 30001\n\ndata_micrographs\n\nloop_ \n')
+    f.writelines('_{} #{} \n'.format(label, i + 1) for i, label in enumerate(LABELS))
+    f.writelines('mic{}.mrc {} {} 4.0\n'.format(i, 10000 + i, 11000 + i) for i in range(n))
+    f.write(' \n')
+
+def test_checkpoint_reads_only_new_rows(tmp_path, capsys):
+  star_file, checkpoint = str(tmp_path / 'micrographs_ctf.star'), str(tmp_path / 'defocus.npz')
+  write_micrographs(star_file, 220)
+  assert micrograph_columns(star_file, LABELS, checkpoint).shape == (3, 220)
+  write_micrographs(star_file, 420)
+  columns = micrograph_columns(star_file, LABELS, checkpoint)
+  assert 'Read 200 new micrographs' in capsys.readouterr().out
+  assert columns.shape == (3, 420)
+  assert columns[0].tolist() == [10000.0 + i for i in range(420)]
+
+def test_unchanged_file_reads_no_rows(tmp_path, capsys):
+  star_file, checkpoint = str(tmp_path / 'micrographs_ctf.star'), str(tmp_path / 'defocus.npz')
+  write_micrographs(star_file, 50)
+  micrograph_columns(star_file, LABELS, checkpoint)
+  assert micrograph_columns(star_file, LABELS, checkpoint).shape == (3, 50)
+  assert 'Read 0 new micrographs' in capsys.readouterr().out
+
+def test_missing_class_raises_value_error():
+  columns = {'rlnDefocusU':np.array([1.0, 2.0]), 'rlnDefocusV':np.array([1.0, 2.0]), 'rlnClassNumber':np.array([1, 2])}
+  assert class_defocus(columns, 2)[2].tolist() == [2.0]
+  with pytest.raises(ValueError):
+    class_defocus(columns, 3)
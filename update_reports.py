@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# Regenerate out of date plots for every job in a RELION project. 19.10.26
+# Uses the output.manifest.json files written by plot_fsc.py, plot_iterations.py, plot_topaz.py and plot_defocus.py
+from __future__ import print_function
+import os
+import sys
+import glob
+import argparse
+import subprocess
+from multiprocessing.pool import ThreadPool
+from manifest import manifest_up_to_date
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def job_type(job_star):
+  with open(job_star) as f:
+    for line in f:
+      if line.startswith('_rlnJobTypeLabel'):
+        return line.split()[1].strip()
+  return None
+
+def find_reports(project):
+  # (script, arguments, output) for each job with something to plot, paths relative to the project directory
+  reports = []
+  for job in sorted(glob.glob(os.path.join(project, 'PostProcess', 'job*'))):
+    job = os.path.relpath(job, project)
+    if os.path.isfile(os.path.join(project, job, 'postprocess.star')):
+      output = os.path.join(job, 'FSC.pdf')
+      reports.append(('plot_fsc.py', [os.path.join(job, 'postprocess.star'), '--output', output], output))
+  for job in sorted(glob.glob(os.path.join(project, 'Class3D', 'job*'))):
+    job = os.path.relpath(job, project)
+    models = sorted(glob.glob(os.path.join(project, job, 'run_it[0-9][0-9][0-9]_model.star')))
+    if len(models) > 0:
+      output = os.path.join(job, 'iterations.pdf')
+      reports.append(('plot_iterations.py', [os.path.relpath(m, project) for m in models] + ['--output', output], output))
+  for job in sorted(glob.glob(os.path.join(project, 'AutoPick', 'job*'))):
+    job = os.path.relpath(job, project)
+    job_star = os.path.join(job, 'job.star')
+    if not os.path.isfile(os.path.join(project, job_star)):
+      continue
+    label = job_type(os.path.join(project, job_star))
+    if label == 'relion.autopick.topaz.pick' and os.path.isfile(os.path.join(project, job, 'autopick.star')):
+      output = os.path.join(job, 'topaz_FOM.pdf')
+    elif label == 'relion.autopick.topaz.train' and os.path.isfile(os.path.join(project, job, 'model_training.txt')):
+      output = os.path.join(job, 'topaz_training.pdf')
+    else:
+      continue
+    reports.append(('plot_topaz.py', [job_star, '--output', output], output))
+  for job in sorted(glob.glob(os.path.join(project, 'CtfFind', 'job*'))):
+    job = os.path.relpath(job, project)
+    if os.path.isfile(os.path.join(project, job, 'micrographs_ctf.star')):
+      output = os.path.join(job, 'defocus.pdf')
+      reports.append(('plot_defocus.py', [os.path.join(job, 'micrographs_ctf.star'), '--output', output], output))
+  return reports
+
+def stale(project, script, args, output):
+  # Same test as the plotting scripts but without starting them: the plot is out of date if it
+  # was last made with a different command or any input recorded in its manifest has changed
+  return not manifest_up_to_date(os.path.join(project, output), lambda manifest: manifest.get('command') == [script] + args)
+
+def run_report(project, script, args, flags):
+  command = [sys.executable, os.path.join(SCRIPT_DIR, script)] + args + flags
+  result = subprocess.run(command, cwd=project, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+  return result.returncode, result.stdout
+
+def update_reports(project, nproc, force, checksum, dry_run):
+  reports = find_reports(project)
+  todo = []
+  for script, args, output in reports:
+    if force or stale(project, script, args, output):
+      todo.append((script, args, output))
+  print('{} of {} plots in {} are out of date'.format(len(todo), len(reports), project))
+  if dry_run:
+    for script, args, output in todo:
+      print(' {} {}'.format(script, ' '.join(args)))
+    return 0
+  flags = (['--force'] if force else []) + (['--checksum'] if checksum else [])
+  failed = 0
+  # each plot runs in its own process so threads are enough to keep nproc of them busy
+  with ThreadPool(nproc) as pool:
+    results = pool.starmap(run_report, [(project, script, args, flags) for script, args, output in todo])
+  for (script, args, output), (returncode, log) in zip(todo, results):
+    if returncode != 0:
+      failed += 1
+      print('FAILED {} {}'.format(script, ' '.join(args)))
+      print(log)
+    else:
+      print('{:<40s} {}'.format(output, log.strip().split('\n')[-1] if log.strip() != '' else ''))
+  if failed > 0:
+    print('{} plots failed'.format(failed))
+  return failed
+
+if __name__=='__main__':
+  parser = argparse.ArgumentParser(description='Regenerate out of date FSC, iteration, Topaz and defocus plots for all jobs in a RELION project')
+  parser.add_argument('project', metavar='.', type=str, nargs='?', default='.',
+                      help='RELION project directory')
+  parser.add_argument('--nproc', required=False, default=os.cpu_count(), metavar='8', type=int,
+                      help='number of plots to make at the same time')
+  parser.add_argument('--force', required=False, default=False, action='store_true',
+                      help='regenerate all plots')
+  parser.add_argument('--checksum', required=False, default=False, action='store_true',
+                      help='record input checksums so only a change of content makes a plot out of date')
+  parser.add_argument('--dry_run', required=False, default=False, action='store_true',
+                      help='only list the out of date plots')
+  args = parser.parse_args()
+  if not os.path.isdir(args.project):
+    sys.exit('Sorry could not find {}'.format(args.project))
+  if update_reports(args.project, args.nproc, args.force, args.checksum, args.dry_run) > 0:
+    sys.exit(1)